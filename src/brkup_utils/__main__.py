@@ -0,0 +1,9 @@
+"""
+Command-line entry point, see brkup_utils.batch
+
+    python -m brkup_utils config.json
+"""
+
+from brkup_utils.batch import main
+
+main()
@@ -0,0 +1,309 @@
+## Batch production of the breakup diagnostics
+"""
+Runs the diagnostics of the notebooks (lead area fraction, deformation,
+ice growth budget) from a config file, without a notebook. The steps
+form a dependency graph: only the steps needed for the requested
+diagnostics are run, and every step that is stored is reused as long as
+its inputs and settings are unchanged.
+
+    moorings -> leads              -> lead_fraction  (also needs masks)
+    moorings -> deformation_fields -> deformation    (also needs masks)
+    moorings -> growth_budget                        (also needs masks)
+    moorings, grid -> masks
+
+Example config (JSON, or YAML if PyYAML is installed):
+
+    {
+     "indir": "/home/rheinlender/shared-simstore-ns9829k/NANUK/NANUK025-ILBOXE140-S/",
+     "outdir": "diagnostics",
+     "cache_dir": "diagnostics/cache",
+     "year_start": 2000,
+     "year_end": 2018,
+     "months": ["01", "02", "03"],
+     "region": "Beaufort",
+     "period": "daily",
+     "masks": ["Moore2022", "Beaufort"],
+     "diagnostics": ["lead_fraction", "deformation", "growth_budget"],
+     "lead_method": "breakup_paper",
+     "lead_threshold": 0.05,
+     "mesh_file": "mesh_mask_NANUK025_3.6.nc",
+     "grid_dir": "/home/rheinlender/shared-simstore-ns9829k/NANUK/NANUK025-I/",
+     "nsidc_grid": "/home/rheinlender/Data/NSIDC/NSIDC_25km_grid.nc",
+     "format": "netcdf"
+    }
+
+The years are "year_start" to "year_end" (both included), or an explicit
+list of years in "years", e.g. "years": [2000, 2005, 2012].
+"grid_dir" (NANUK grid) and "nsidc_grid" (NSIDC regions) default to 
+NANUK_GRIDDIR and NSIDC_GRIDDIR in mask_funcs.
+"masks" are 'Moore2022', 'large_Beaufort' or NSIDC regions (NSIDC_region_dic).
+
+Usage:
+    python -m brkup_utils config.json [--diagnostics lead_fraction] [--force]
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import xarray as xr
+from brkup_utils.boxnames import *
+from brkup_utils.store_funcs import write_store
+
+DEFAULTS = {'outdir':'diagnostics', 'cache_dir':None, 'months':['01', '02', '03'],
+            'region':'Beaufort', 'period':'daily', 'masks':['Moore2022'],
+            'diagnostics':['lead_fraction'], 'lead_method':'breakup_paper',
+            'lead_threshold':0.05, 'grid_dir':None, 'nsidc_grid':None, 'mesh_file':None, 
+            'format':'netcdf'}
+
+# step: (dependencies, config entries it depends on, stored in outdir)
+STEPS = {'moorings':([], ['indir', 'years', 'months', 'region', 'period'], False),
+         'grid':([], ['grid_dir', 'region'], False),
+         'masks':(['moorings', 'grid'], ['masks', 'grid_dir', 'nsidc_grid'], True),
+         'leads':(['moorings'], ['lead_method', 'lead_threshold'], True),
+         'lead_fraction':(['leads', 'masks', 'grid'], [], True),
+         'deformation_fields':(['moorings'], ['mesh_file'], True),
+         'deformation':(['deformation_fields', 'masks', 'grid'], [], True),
+         'growth_budget':(['moorings', 'masks', 'grid'], [], True)}
+
+DIAGNOSTICS = ['leads', 'lead_fraction', 'deformation_fields', 'deformation', 'growth_budget']
+
+#########################################################
+def read_config(config_file):
+    """Read JSON (or YAML) config and fill in the defaults"""
+    with open(config_file) as f:
+        if config_file.endswith(('.yml', '.yaml')):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    for key, val in DEFAULTS.items():
+        config.setdefault(key, val)
+    if 'indir' not in config:
+        raise ValueError("config needs 'indir'")
+
+    if 'years' in config:
+        if 'year_start' in config or 'year_end' in config:
+            raise ValueError("config needs either 'years' or 'year_start' and 'year_end', not both")
+        years = config['years']
+    elif 'year_start' in config and 'year_end' in config:
+        years = range(int(config['year_start']), int(config['year_end'])+1)
+    else:
+        raise ValueError("config needs 'years' or 'year_start' and 'year_end'")
+
+    config['years'] = [int(yr) for yr in years]
+    return config
+
+def get_order(diagnostics):
+    """Steps needed for the diagnostics, in dependency order"""
+    order = []
+    def visit(step):
+        if step not in STEPS:
+            raise ValueError("Unknown diagnostic:", step)
+        if step in order:
+            return
+        for dep in STEPS[step][0]:
+            visit(dep)
+        order.append(step)
+    for diag in diagnostics:
+        visit(diag)
+    return order
+
+#########################################################
+# steps
+
+def step_moorings(config, inputs):
+    from brkup_utils import process_data
+    return process_data.load_moorings(config['indir'], config['months'], config['years'],
+                                      region=config['region'], period=config['period'],
+                                      pushdown=config['region'] is not None,
+                                      cache_dir=config['cache_dir'])
+
+def step_grid(config, inputs):
+    from brkup_utils.grid_funcs import CREGgrid
+    from brkup_utils.mask_funcs import NANUK_GRIDDIR
+    grid_dir = config['grid_dir'] if config['grid_dir'] is not None else NANUK_GRIDDIR
+    bbox = BOXNAMES[config['region']] if config['region'] is not None else None
+
+    area = CREGgrid(grid_dir, bbox, persist=True).get_area()
+    grid = xr.Dataset({'mod_area':(('y', 'x'), area)})
+    grid['mod_area'].attrs = {'units':'m2', 'long_name':'grid_cell_area'}
+    return grid
+
+def step_masks(config, inputs):
+    from brkup_utils import mask_funcs as msk
+    ds = inputs['moorings']
+    bbox = BOXNAMES[config['region']] if config['region'] is not None else None
+    grid_dir = config['grid_dir'] if config['grid_dir'] is not None else msk.NANUK_GRIDDIR
+    nsidc_grid = config['nsidc_grid'] if config['nsidc_grid'] is not None else msk.NSIDC_GRIDDIR
+    Mask = msk.Masking(ds[['longitude', 'latitude']].load(), bbox=bbox, cache_dir=config['cache_dir'],
+                       grid_dir=grid_dir, nsidc_file=nsidc_grid)
+
+    masks = []
+    for name in config['masks']:
+        if name == 'Moore2022':
+            mask = Mask.get_Moore2022_Beaufort_mask()
+        elif name == 'large_Beaufort':
+            mask = Mask.get_large_Beaufort_mask()
+        else:
+            mask = Mask.get_nsidc_mask(name)['data']
+        mask = np.asarray(mask) == 1
+        mask[np.isnan(inputs['grid']['mod_area'].values)] = False # remove land
+        masks.append(mask.astype(np.int8))
+
+    return xr.Dataset({'mask':(('region', 'y', 'x'), np.stack(masks))},
+                      coords={'region':config['masks']})
+
+def step_leads(config, inputs):
+    from brkup_utils import lead_detect
+    leadfrac, leadmask = lead_detect.map_leads(inputs['moorings'], config['lead_method'],
+                                               config['lead_threshold'])
+    return xr.Dataset({'leadfrac':leadfrac, 'leadmask':leadmask})
+
+def step_lead_fraction(config, inputs):
+    reducer = get_reducer(inputs)
+    return reducer.reduce(inputs['leads'], variables=['leadmask', 'leadfrac'])
+
+def step_deformation_fields(config, inputs):
+    from brkup_utils import process_data
+    from brkup_utils.calc_deformation_NANUK import deformation
+    if config['mesh_file'] is None:
+        raise ValueError("deformation needs 'mesh_file' (grid with e1u and e1v)")
+
+    grid = xr.open_dataset(config['mesh_file'])
+    if config['region'] is not None:
+        grid = process_data.subset_data_region(grid, config['region'])
+    ds = deformation(inputs['moorings'], grid)
+    return ds[['shear', 'div', 'deform']]
+
+def step_deformation(config, inputs):
+    reducer = get_reducer(inputs)
+    return reducer.reduce(inputs['deformation_fields'], variables=['shear', 'div', 'deform'])
+
+def step_growth_budget(config, inputs):
+    from brkup_utils.calc_IceGrowth import IceGrowth
+    ds = inputs['moorings'].assign(mod_area=inputs['grid']['mod_area'])
+    Igrowth = IceGrowth(ds)
+    Igrowth.fix_growthrate()
+
+    return Igrowth.calc_budget(get_masks(inputs))
+
+def get_masks(inputs):
+    masks = inputs['masks']['mask']
+    return {str(region):masks.sel(region=region).values for region in masks.region.values}
+
+def get_reducer(inputs):
+    from brkup_utils.region_reduce import RegionReducer
+    return RegionReducer.from_masks(get_masks(inputs), area=inputs['grid']['mod_area'].values)
+
+#########################################################
+class Pipeline:
+    "Runs the steps for the requested diagnostics and stores the results in outdir"
+
+    def __init__(self, config, force=False):
+        """
+        Parameters:
+        -----------
+        config : dict (see read_config)
+        force : bool
+            recompute all steps, even if stored results are up to date
+        """
+        self.config = config
+        self.force = force
+        self.keys = {}
+        self.results = {}
+        os.makedirs(config['outdir'], exist_ok=True)
+
+    def step_key(self, step):
+        """Hash of the step's settings, its input files and the keys of its dependencies"""
+        deps, entries, _ = STEPS[step]
+        content = {'step':step, 'config':{key:self.config[key] for key in entries},
+                   'deps':[self.keys[dep] for dep in deps]}
+        if step == 'moorings':
+            from brkup_utils.mooring_cache import MooringCache
+            from brkup_utils.process_data import mooring_files
+            files = mooring_files(self.config['indir'], self.config['months'], self.config['years'])
+            content['files'] = MooringCache.make_key(files, self.config['region'], self.config['months'],
+                                                     self.config['years'], self.config['period'])
+        return hashlib.sha1(json.dumps(content, default=str).encode()).hexdigest()
+
+    def path(self, step):
+        ext = '.zarr' if self.config['format'] == 'zarr' else '.nc'
+        return os.path.join(self.config['outdir'], step + ext)
+
+    def load(self, step, key):
+        """Stored result of a step if it was computed with the same key"""
+        keyfile = self.path(step) + '.key'
+        if self.force or not os.path.isfile(keyfile) or not os.path.exists(self.path(step)):
+            return None
+        with open(keyfile) as f:
+            if f.read().strip() != key:
+                return None
+        print('reusing', self.path(step))
+        return self.open(step)
+
+    def open(self, step):
+        if self.config['format'] == 'zarr':
+            return xr.open_zarr(self.path(step))
+        return xr.open_dataset(self.path(step), chunks={})
+
+    def save(self, step, key, ds):
+        """Write the result of a step (temporary name, then moved in place) and its key"""
+        store = self.path(step)
+        print('writing', store)
+        write_store(ds, store, zarr=self.config['format'] == 'zarr')
+
+        with open(store + '.key', 'w') as f:
+            f.write(key)
+
+        return self.open(step)
+
+    def run(self, diagnostics=None):
+        """
+        Parameters:
+        -----------
+        diagnostics : list(str) default is config['diagnostics']
+
+        Returns:
+        --------
+        results : dict {step: xarray.Dataset}
+        """
+        if diagnostics is None:
+            diagnostics = self.config['diagnostics']
+
+        for step in get_order(diagnostics):
+            self.keys[step] = self.step_key(step)
+
+        return {diag:self.get(diag) for diag in diagnostics}
+
+    def get(self, step):
+        """Result of a step: stored result if up to date, otherwise computed (with its dependencies)"""
+        if step in self.results:
+            return self.results[step]
+
+        key = self.keys[step]
+        stored = STEPS[step][2]
+        ds = self.load(step, key) if stored else None
+        if ds is None:
+            inputs = {dep:self.get(dep) for dep in STEPS[step][0]}
+            print('running', step)
+            ds = globals()['step_' + step](self.config, inputs)
+            if stored:
+                ds = self.save(step, key, ds)
+
+        self.results[step] = ds
+        return ds
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m brkup_utils',
+                                     description='Compute breakup diagnostics from nextsim moorings')
+    parser.add_argument('config', help='config file (JSON or YAML)')
+    parser.add_argument('--diagnostics', nargs='+', default=None, choices=DIAGNOSTICS,
+                        help='diagnostics to compute (default from config)')
+    parser.add_argument('--force', action='store_true', help='recompute stored results')
+    args = parser.parse_args(argv)
+
+    config = read_config(args.config)
+    Pipeline(config, force=args.force).run(args.diagnostics)
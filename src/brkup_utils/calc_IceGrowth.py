@@ -28,21 +28,81 @@ class IceGrowth:
         '''
 
         # get freq from mooring
-        dt_in_hours = self.dataset.time.dt.hour[1] - self.dataset.time.dt.hour[0]
-        output_timestep = dt_in_hours.values/24 
+        dt = self.dataset.time.values[1] - self.dataset.time.values[0]
+        output_timestep = dt/np.timedelta64(1, 'D')
         output_freq = 1/output_timestep
 
         print("output frequency ", output_freq)
 
-        # apply to growth rate variables
-        for var in self.variables:
-            print(var)
-            self.dataset[var] = self.dataset[var]/output_freq
+        # apply to all growth rate variables at once
+        variables = [var for var in ['newice', 'del_vi_thin', 'del_hi'] if var in self.dataset]
+        self.dataset.update(self.dataset[variables]*output_timestep)
 
-            if var=='del_hi': # fix units
-                self.dataset['del_vi'] = self.dataset['del_hi']*(self.dataset['sic'] - self.dataset['sic_thin'])      
+        if 'del_hi' in variables: # fix units
+            self.dataset['del_vi'] = self.dataset['del_hi']*(self.dataset['sic'] - self.dataset['sic_thin'])      
         return
 
+    def get_terms(self):
+        '''Growth terms in volume units (del_hi is replaced by del_vi from fix_growthrate)'''
+        if self.variables == ['newice', 'del_vi_thin', 'del_hi']:
+            if 'del_vi' not in self.dataset:
+                # del_hi is a thickness, it cannot be used as a volume growth
+                raise KeyError("'del_vi' is missing, call fix_growthrate() first")
+            self.variables = ['newice', 'del_vi_thin', 'del_vi'] 
+        return self.variables
+
+    def get_region_weights(self, masks):
+        '''
+        Area weights of each region (area inside the region, 0 outside and over land)
+
+            Parameters:
+                masks (dict or array): region mask(s) (1 or 0) on (y, x), 
+                    as a dict {region name: mask} or a single mask
+
+            Returns:
+                weights (xr.DataArray): (region, y, x) 
+        '''
+        if not isinstance(masks, dict):
+            masks = {'region':masks}
+
+        ocean = ~np.isnan(self.dataset['sic'].isel(time=0, drop=True)) # remove nans
+        area = self.dataset['mod_area'].fillna(0)
+
+        weights = []
+        for mask in masks.values():
+            if not isinstance(mask, xr.DataArray):
+                mask = xr.DataArray(np.asarray(mask), dims=('y', 'x'))
+            weights.append(area.where((mask == 1) & ocean, 0))
+
+        weights = xr.concat(weights, dim='region', coords='minimal', compat='override')
+        return weights.assign_coords(region=list(masks.keys()))
+
+    def calc_budget(self, masks, terms=None):
+        '''
+        Ice volume growth of all growth terms in all regions in a single pass
+
+            Parameters:
+                masks (dict or array): region mask(s) (1 or 0), as a dict 
+                    {region name: mask} or a single mask
+                terms (list): growth terms. Default is self.variables
+
+            Returns:
+                budget (xr.Dataset): 'delV' (time, region, term), 
+                    total ice volume growth (m3/output_freq) 
+        '''
+        if terms is None:
+            terms = self.get_terms()
+
+        weights = self.get_region_weights(masks)
+
+        # stack the terms and reduce them together with the area weights
+        growth = self.dataset[terms].to_array(dim='term').fillna(0)
+        delV = xr.dot(growth, weights, dim=('y', 'x'))
+        delV = delV.transpose('time', 'region', 'term')
+        delV.attrs = {'units':'m3', 'long_name':'ice volume growth'}
+
+        return xr.Dataset({'delV':delV})
+
     def calc_vol_growth(self, mask):
         '''
         Calculates the ice volume growth from nextsim moorings
@@ -55,48 +115,44 @@ class IceGrowth:
                 delVsum (xr.Dataset): Total ice volume growth (m3/output_freq) 
 
         '''
-        area = self.dataset['mod_area']    
-        
-        # update variable list
-        if self.variables == ['newice', 'del_vi_thin', 'del_hi']:
-            self.variables = ['newice', 'del_vi_thin', 'del_vi'] 
-        
-        delVsum=xr.Dataset()
-        for var in self.variables:
-              
-            # convert to volume growth
-            delV = area*self.dataset[var] # in m3/?hrs
-
-            # apply mask
-            mask = mask*(~np.isnan(self.dataset['sic'][0])) # remove nans
-            delVmsk = delV.where(mask==1)
+        budget = self.calc_budget(mask)
+        delVsum = budget['delV'].isel(region=0, drop=True).to_dataset(dim='term')
 
-            delVsum[var] = delVmsk.sum(dim=("x", "y"), skipna=True) # m3/?hrs total volume growth
-            
+        for var in delVsum.data_vars:
             # fix attributes 
             delVsum[var].attrs = {'units':'m2'}
             
         return  delVsum
 
-    def get_total_growth(self, dVol):
+    def get_total_growth(self, dVol, by='year', cumulative=False):
         '''
         Calculates the total amount of ice volume growth
             Parameters:
-                dVol (xr.DataArray): ice growth 
+                dVol (xr.Dataset): ice growth 
+                by (str): 'year', 'season' (DJF, MAM, ...) or 'month'
+                cumulative (bool): return the cumulative growth curves 
+                    within each period (lazy) instead of the totals
 
             Returns:
-                total_growth (dict):  Cumulative ice volume growth (m3) 
+                total_growth (xr.Dataset):  Total (or cumulative) ice volume growth (m3) 
+                    of each variable, indexed by 'by'
         '''
-
-        # group by year
-        yearly = dVol.groupby('time.year')
-
-        total_growth = {}
-        for var in self.variables:
-            csum=[]
-            for year, darr in yearly:
-                # cumulative sum
-                csum.append(darr[var].cumsum(axis=0).values[-1])
-
-            total_growth[var] = np.array(np.float32(csum))    
-        return total_growth
\ No newline at end of file
+        variables = [var for var in self.variables if var in dVol]
+        dVol = dVol[variables]
+
+        if by == 'year':
+            labels = dVol['time.year']
+        elif by in ['season', 'month']:
+            freq = {'season':'Q-NOV', 'month':'M'}[by] # seasons start in December
+            time = dVol.indexes['time'].to_period(freq).to_timestamp(how='start')
+            labels = xr.DataArray(time, dims='time', coords={'time':dVol.time}, name=by)
+        else:
+            raise ValueError("Unknown period:", by)
+
+        if cumulative:
+            csum = dVol.groupby(labels).cumsum(dim='time')
+            return csum.assign_coords({by:labels})
+
+        # one pass over the data for all variables and periods
+        total_growth = dVol.groupby(labels).sum(dim='time').compute()
+        return total_growth
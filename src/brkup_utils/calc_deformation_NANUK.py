@@ -5,11 +5,21 @@ Created on Fri Apr 21 2023
 @authors: Jonathan Rheinlænder
 """
 
+import os
+import hashlib
 import numpy as np
+import xarray as xr
+import dask
+import dask.array as dsa
 import datetime
 import metpy.calc as mpcalc
 from metpy.units import units
 
+try:
+    from numba import njit, prange
+except ImportError: # fall back to numpy
+    njit = None
+
 #########################################################
 def calc_deformation_rate(uv, dx, dy, dt=24*60*60, x_dim=-1, y_dim=-2):
     '''
@@ -62,6 +72,195 @@ def calc_deformation_rate(uv, dx, dy, dt=24*60*60, x_dim=-1, y_dim=-2):
     return shear, div, deform
 
 
+def _grad(f, i, j, axis):
+    """np.gradient (edge_order=1, unit spacing) of 2D array 'f' at point (i, j)"""
+    if axis==0:
+        n = f.shape[0]
+        if i==0:
+            return f[1, j] - f[0, j]
+        elif i==n-1:
+            return f[n-1, j] - f[n-2, j]
+        return 0.5*(f[i+1, j] - f[i-1, j])
+    else:
+        n = f.shape[1]
+        if j==0:
+            return f[i, 1] - f[i, 0]
+        elif j==n-1:
+            return f[i, n-1] - f[i, n-2]
+        return 0.5*(f[i, j+1] - f[i, j-1])
+
+def _deformation_step(u, v, dx, dy, dt, shear, div, deform, t):
+    """Shear, divergence and total deformation of time step t"""
+    nt, ny, nx = u.shape
+    for i in range(ny):
+        for j in range(nx):
+            dudx = _grad(u[t], i, j, 1)/dx[i, j]
+            dudy = _grad(u[t], i, j, 0)/dy[i, j]
+            dvdy = _grad(v[t], i, j, 0)/dy[i, j]
+            dvdx = _grad(v[t], i, j, 1)/dx[i, j]
+            
+            d = dt*(dudx + dvdy)
+            s = dt*np.hypot(dudx - dvdy, dudy + dvdx)
+            div[t, i, j] = d
+            shear[t, i, j] = s
+            deform[t, i, j] = np.hypot(d, s)
+
+def _deformation_kernel(u, v, dx, dy, dt, shear, div, deform):
+    """Shear, divergence and total deformation of (time, y, x) arrays in a single pass"""
+    for t in prange(u.shape[0]):
+        _deformation_step(u, v, dx, dy, dt, shear, div, deform, t)
+
+def _deformation_kernel_serial(u, v, dx, dy, dt, shear, div, deform):
+    """Same as _deformation_kernel, single-threaded"""
+    for t in range(u.shape[0]):
+        _deformation_step(u, v, dx, dy, dt, shear, div, deform, t)
+
+if njit is not None:
+    _grad = njit(_grad, cache=True)
+    _deformation_step = njit(_deformation_step, cache=True)
+    # the parallel kernel must not be called from several threads at once (e.g. dask workers).
+    # The serial kernel is a separate function, so it has its own numba cache entry
+    _deformation_kernel_serial = njit(_deformation_kernel_serial, cache=True)
+    _deformation_kernel = njit(_deformation_kernel, parallel=True, cache=True)
+
+def calc_deformation_rate_fused(u, v, dx, dy, dt=24*60*60, time_chunk=None, out=None, parallel=True):
+    '''
+    Same as calc_deformation_rate, but shear, divergence and total deformation 
+    are computed in one pass (numba kernel, numpy if numba is not installed) into 
+    preallocated output arrays. Only 'time_chunk' time steps of u and v are 
+    loaded at a time, so the memory needed is bounded.
+    
+    Parameters:
+    -----------
+    u, v : x/y components of ice velocity with dims (time,y,x) or (y,x). 
+        Can be numpy arrays or (lazy) xarray.DataArrays
+    dx : spacing in x-direction (columns). Can be array (y,x) or scalar
+    dy: spacing in y-direction (rows). Can be array (y,x) or scalar
+    dt: time conversion, e.g. from sec to day 
+    time_chunk: int
+        number of time steps processed at once. Default is all
+    out: tuple of arrays (shear, div, deform)
+        preallocated outputs with the same shape as u
+    parallel: bool
+        use the multi-threaded numba kernel. Set to False when called from 
+        threads, e.g. inside dask tasks
+    
+    Returns:
+    --------
+    shear, divergence and total deformation. Dimensions: (time, y, x)
+    '''
+    squeeze = (np.ndim(u)==2)
+    if squeeze:
+        u = u[np.newaxis]
+        v = v[np.newaxis]
+    
+    nt, ny, nx = np.shape(u)
+    dx = np.ascontiguousarray(np.broadcast_to(np.squeeze(dx), (ny, nx)), dtype=np.float64)
+    dy = np.ascontiguousarray(np.broadcast_to(np.squeeze(dy), (ny, nx)), dtype=np.float64)
+    
+    if out is None:
+        out = tuple(np.empty((nt, ny, nx)) for i in range(3))
+    shear, div, deform = out
+    
+    if time_chunk is None:
+        time_chunk = nt
+    
+    for t0 in range(0, nt, time_chunk):
+        t1 = min(t0 + time_chunk, nt)
+        u_chunk = np.ascontiguousarray(u[t0:t1], dtype=np.float64)
+        v_chunk = np.ascontiguousarray(v[t0:t1], dtype=np.float64)
+        
+        if njit is not None:
+            kernel = _deformation_kernel if parallel else _deformation_kernel_serial
+            kernel(u_chunk, v_chunk, dx, dy, float(dt), 
+                                shear[t0:t1], div[t0:t1], deform[t0:t1])
+        else:
+            shear[t0:t1], div[t0:t1], deform[t0:t1] = calc_deformation_rate(
+                [u_chunk, v_chunk], dx, dy, dt=dt)
+    
+    if squeeze:
+        return shear[0], div[0], deform[0]
+    return shear, div, deform
+
+
+def _deformation_block(u, v, dx, dy, dt):
+    """Deformation of one (time, y, x) block, stacked as (3, time, y, x)"""
+    return np.stack(calc_deformation_rate_fused(u, v, dx, dy, dt=dt, parallel=False))
+
+def _deformation_array(u, v, dx, dy, dt=24*60*60):
+    """
+    Deformation of numpy or dask arrays (..., y, x). Dask arrays are processed 
+    lazily block by block with a halo of one grid cell in y and x, so the 
+    gradients at the chunk edges are the same as for the full array
+    """
+    shp = u.shape
+    u = u.reshape((-1,) + shp[-2:])
+    v = v.reshape((-1,) + shp[-2:])
+    dx = np.asarray(dx, dtype=np.float64)
+    dy = np.asarray(dy, dtype=np.float64)
+    
+    if not isinstance(u, dsa.Array):
+        out = _deformation_block(u, v, dx, dy, dt)
+        return tuple(arr.reshape(shp) for arr in out)
+    
+    v = v.rechunk(u.chunks)
+    dx = dsa.from_array(np.broadcast_to(dx, shp[-2:]), chunks=u.chunks[-2:])
+    dy = dsa.from_array(np.broadcast_to(dy, shp[-2:]), chunks=u.chunks[-2:])
+    
+    # add halo from neighbouring chunks (nothing at the domain edges)
+    depth = {0:0, 1:1, 2:1}
+    boundary = {0:'none', 1:'none', 2:'none'}
+    ug = dsa.overlap.overlap(u, depth=depth, boundary=boundary)
+    vg = dsa.overlap.overlap(v, depth=depth, boundary=boundary)
+    dxg = dsa.overlap.overlap(dx, depth={0:1, 1:1}, boundary={0:'none', 1:'none'})
+    dyg = dsa.overlap.overlap(dy, depth={0:1, 1:1}, boundary={0:'none', 1:'none'})
+    
+    out = dsa.map_blocks(_deformation_block, ug, vg, dxg, dyg, dt=dt, 
+                         new_axis=0, chunks=((3,),) + ug.chunks, dtype=np.float64)
+    out = dsa.overlap.trim_internal(out, {0:0, 1:0, 2:1, 3:1}, boundary={1:'none', 2:'none', 3:'none'})
+    
+    return tuple(out[i].reshape(shp) for i in range(3))
+
+def deformation(ds, grid, dt=24*60*60, u='siu', v='siv'):
+    '''
+    Shear, divergence and total deformation of a (lazy) dataset. Dask-chunked 
+    velocities are processed out-of-core, with a halo so that gradients are 
+    correct at the chunk edges
+    
+    Parameters:
+    -----------
+    ds : xarray.Dataset with ice velocity components (time, y, x)
+    grid : xarray.Dataset
+        grid with spacing 'e1u' (x-direction) and 'e1v' (y-direction), on the 
+        same (y, x) grid as ds, e.g. mesh_mask_NANUK025_3.6.nc subset with subset_data_region
+    dt: time conversion, e.g. from sec to day 
+    u, v : (str) names of the velocity components
+    
+    Returns:
+    --------
+    ds : xarray.Dataset with 'shear', 'div' and 'deform' added
+    '''
+    dx = grid['e1u'].squeeze(drop=True).transpose('y', 'x')
+    dy = grid['e1v'].squeeze(drop=True).transpose('y', 'x')
+    # use the coordinates of the moorings
+    dx = xr.DataArray(dx.values, dims=('y', 'x'))
+    dy = xr.DataArray(dy.values, dims=('y', 'x'))
+    
+    shear, div, deform = xr.apply_ufunc(_deformation_array, ds[u], ds[v], dx, dy,
+                                        kwargs={'dt':dt},
+                                        input_core_dims=[['y', 'x']]*4,
+                                        output_core_dims=[['y', 'x']]*3,
+                                        dask='allowed')
+    
+    ds = ds.assign(shear=shear, div=div, deform=deform)
+    
+    ds.shear.attrs = dict(long_name="Shear", units="1/day")
+    ds.div.attrs = dict(long_name="Divergence", units="1/day")
+    ds.deform.attrs = dict(long_name="Total deformation", units="1/day")
+    
+    return ds
+
+
 def calc_deformation_rate_Metpy(u, v, dx, dy, dt=24*60*60):
     '''
     Using MetPy.gradient to calculate deformation
@@ -91,3 +290,153 @@ def calc_deformation_rate_Metpy(u, v, dx, dy, dt=24*60*60):
              
     return shear, div, deform
 
+
+
+class DeformationPyramid:
+    "Deformation rates at several spatial (and temporal) scales by coarse-graining the velocities"
+    
+    def __init__(self, ds, grid, factors=[1, 2, 4, 8], time_factors=[1], dt=24*60*60, 
+                 cache_dir=None, u='siu', v='siv', files=None, key=None):
+        """
+        Parameters:
+        -----------
+        ds : xarray.Dataset with ice velocity components (time, y, x)
+        grid : xarray.Dataset with grid spacing 'e1u' and 'e1v' (see deformation)
+        factors : list(int) 
+            coarse-graining factors in x and y (1 = native grid)
+        time_factors : list(int) 
+            coarse-graining factors in time (1 = native output frequency)
+        dt : time conversion, e.g. from sec to day 
+        cache_dir : (str)
+            directory where each level is saved as NetCDF and reused. The file 
+            names contain a hash of the input (see input_key)
+        u, v : (str) names of the velocity components
+        files : list(str)
+            mooring files ds was read from, their path, mtime and size are 
+            part of the cache key
+        key : (str)
+            explicit cache key, replaces input_key()
+        """
+        self.ds = ds[[u, v]]
+        self.u = u
+        self.v = v
+        self.dx = xr.DataArray(grid['e1u'].squeeze(drop=True).transpose('y', 'x').values, dims=('y', 'x'))
+        self.dy = xr.DataArray(grid['e1v'].squeeze(drop=True).transpose('y', 'x').values, dims=('y', 'x'))
+        self.factors = factors
+        self.time_factors = time_factors
+        self.dt = dt
+        self.cache_dir = cache_dir
+        self.files = files
+        self.levels = {}
+        self.key = key if key is not None else self.input_key()
+    
+    def input_key(self):
+        '''
+        Hash identifying the input: velocity names, sizes, time axis, 
+        coordinates, grid spacing, dt, the input files (path, mtime and size) 
+        if given, and the velocities of the first and last time step
+        '''
+        sha1 = hashlib.sha1()
+        sha1.update(repr((self.u, self.v, float(self.dt), dict(self.ds.sizes),
+                          self.ds.encoding.get('source'))).encode())
+        if self.files is not None:
+            from brkup_utils.mooring_cache import MooringCache
+            sha1.update(MooringCache.make_key(self.files).encode())
+        for name in [self.u, self.v]:
+            sample = self.ds[name].isel(time=[0, -1]).values
+            sha1.update(np.ascontiguousarray(sample, dtype=np.float64).tobytes())
+        for name in ['time', 'x', 'y', 'longitude', 'latitude']:
+            if name in self.ds.coords:
+                sha1.update(np.ascontiguousarray(self.ds[name].values).tobytes())
+        sha1.update(np.ascontiguousarray(self.dx.values).tobytes())
+        sha1.update(np.ascontiguousarray(self.dy.values).tobytes())
+        return sha1.hexdigest()[:16]
+    
+    def cache_file(self, factor, time_factor):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'deformation_{self.key}_x{factor}_t{time_factor}.nc')
+    
+    def coarsen(self, factor, time_factor=1):
+        """
+        Block-average velocities over factor x factor cells (and time_factor time steps). 
+        The spacing of the coarse cells is the sum of the fine spacings along the 
+        direction and their mean across it
+        """
+        ds = self.ds
+        dx, dy = self.dx, self.dy
+        if factor > 1:
+            ds = ds.coarsen(x=factor, y=factor, boundary='trim').mean()
+            dx = dx.coarsen(x=factor, boundary='trim').sum().coarsen(y=factor, boundary='trim').mean()
+            dy = dy.coarsen(y=factor, boundary='trim').sum().coarsen(x=factor, boundary='trim').mean()
+        if time_factor > 1:
+            ds = ds.coarsen(time=time_factor, boundary='trim').mean()
+        
+        grid = xr.Dataset({'e1u':dx, 'e1v':dy})
+        return ds, grid
+    
+    def get_level(self, factor, time_factor=1):
+        """Deformation at one level (lazy unless it was computed or cached before)"""
+        key = (factor, time_factor)
+        if key not in self.levels:
+            fl = self.cache_file(factor, time_factor)
+            if fl is not None and os.path.isfile(fl):
+                self.levels[key] = xr.open_dataset(fl)
+            else:
+                ds, grid = self.coarsen(factor, time_factor)
+                ds = deformation(ds, grid, dt=self.dt, u=self.u, v=self.v)
+                ds['dx'] = grid['e1u']
+                ds['dy'] = grid['e1v']
+                self.levels[key] = ds
+        return self.levels[key]
+    
+    def compute(self):
+        """
+        Compute all levels together, so the velocities are read only once. 
+        Levels are saved in cache_dir if given
+        
+        Returns:
+        --------
+        levels : dict((factor, time_factor): xarray.Dataset)
+        """
+        keys = [(f, tf) for f in self.factors for tf in self.time_factors]
+        lazy = [self.get_level(*key) for key in keys]
+        computed = dask.compute(*lazy)
+        
+        for key, ds in zip(keys, computed):
+            self.levels[key] = ds
+            fl = self.cache_file(*key)
+            if fl is not None and not os.path.isfile(fl):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                ds.to_netcdf(fl)
+        return self.levels
+    
+    def scaling(self, var='deform', moments=[1, 2, 3]):
+        """
+        Scale dependence of deformation: spatial mean of var**q at each level
+        
+        Parameters:
+        -----------
+        var : (str) 'deform', 'shear' or 'div'
+        moments : list(float) moments q
+        
+        Returns:
+        --------
+        stats : xarray.DataArray (time_scale, length_scale, moment)
+            length_scale is the mean size sqrt(dx*dy) of the cells in km, 
+            time_scale the coarse-graining factor in time
+        """
+        self.compute()
+        q = xr.DataArray(moments, dims='moment', coords={'moment':moments})
+        
+        stats = []
+        for tf in self.time_factors:
+            per_scale = []
+            for f in self.factors:
+                ds = self.levels[(f, tf)]
+                L = float(np.sqrt(ds['dx']*ds['dy']).mean())*1e-3
+                absvar = np.abs(ds[var])
+                per_scale.append((absvar**q).mean(dim=('time', 'y', 'x')).expand_dims(length_scale=[L]))
+            stats.append(xr.concat(per_scale, dim='length_scale').expand_dims(time_scale=[tf]))
+        
+        return xr.concat(stats, dim='time_scale')
@@ -0,0 +1,126 @@
+## Hourly to daily ERA5 preprocessing
+"""
+Average hourly ERA5 into the daily files read by OpenerEra5
+(ERA5/daily/ERA5_${varname}_y%Y_daily.nc). One task per variable-year,
+run in a process pool. Outputs that already exist are skipped, so an
+interrupted run can be restarted.
+
+Usage:
+    python -m brkup_utils.era5_daily --variables u10 v10 msl --years 2000 2018
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import xarray as xr
+from brkup_utils.store_funcs import write_store
+
+DATA_DIR = '/home/rheinlender/shared-simstore-ns9829k/data/'
+NAME_MASK = 'ERA5/ERA5_%s_y%s.nc'
+OUT_MASK = 'ERA5/daily/ERA5_%s_y%s_daily.nc'
+
+#########################################################
+
+def daily_average_file(infile, outfile, complevel=4, time_chunk=24*31):
+    """
+    Average hourly ERA5 file to daily means and write a compressed, chunked
+    NetCDF file. The file is written under a temporary name and renamed when
+    complete, so 'outfile' only exists if it is complete
+
+    Parameters:
+    -----------
+    infile : (str) hourly ERA5 file
+    outfile : (str) daily output file
+    complevel : int
+        zlib compression level
+    time_chunk : int
+        number of hourly time steps read at once (default one month), so 
+        each task only holds a month of hourly data in memory
+
+    Returns:
+    --------
+    outfile : (str)
+    """
+    with xr.open_dataset(infile, chunks={'time':time_chunk}) as ds:
+        ds_daily = ds.resample(time='D').mean(dim='time')
+
+        encoding = {}
+        for var in ds_daily.data_vars:
+            chunks = tuple(1 if dim=='time' else size for dim, size in zip(ds_daily[var].dims, ds_daily[var].shape))
+            encoding[var] = {'zlib':True, 'complevel':complevel, 'chunksizes':chunks}
+
+        write_store(ds_daily, outfile, zarr=False, encoding=encoding, unlimited_dims=['time'])
+
+    return outfile
+
+def is_complete(outfile):
+    """Check that the output exists and can be read"""
+    if not os.path.isfile(outfile):
+        return False
+    try:
+        with xr.open_dataset(outfile) as ds:
+            return ds.sizes.get('time', 0) > 0
+    except (OSError, ValueError):
+        return False
+
+def run(variables, years, data_dir=DATA_DIR, out_dir=None, max_workers=None, overwrite=False):
+    """
+    Parameters:
+    -----------
+    variables : list(str) ERA5 variable names, e.g. ['u10', 'v10', 'msl']
+    years : list(int)
+    data_dir : (str)
+        directory with the hourly files (NAME_MASK)
+    out_dir : (str)
+        directory with the daily files. Default is OUT_MASK in data_dir
+    max_workers : int
+        number of processes. Default is the number of cores
+    overwrite : bool
+        recompute outputs that already exist
+
+    Returns:
+    --------
+    outfiles : list(str) files that were written
+    """
+    tasks = []
+    for var in variables:
+        for yr in years:
+            infile = os.path.join(data_dir, NAME_MASK %(var, yr))
+            if out_dir is None:
+                outfile = os.path.join(data_dir, OUT_MASK %(var, yr))
+            else:
+                outfile = os.path.join(out_dir, os.path.basename(OUT_MASK %(var, yr)))
+
+            if not overwrite and is_complete(outfile):
+                print('Skipping', outfile)
+                continue
+
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            tasks.append((infile, outfile))
+
+    outfiles = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(daily_average_file, *task):task for task in tasks}
+        for future in as_completed(futures):
+            outfile = future.result()
+            print('Saved', outfile)
+            outfiles.append(outfile)
+
+    return outfiles
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Average hourly ERA5 files to daily means')
+    parser.add_argument('--variables', nargs='+', required=True, help='ERA5 variables, e.g. u10 v10 msl')
+    parser.add_argument('--years', nargs=2, type=int, required=True, metavar=('YEAR0', 'YEAR1'),
+                        help='first and last year')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='directory with the hourly ERA5 files')
+    parser.add_argument('--out-dir', default=None, help='directory for the daily files')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--overwrite', action='store_true', help='recompute existing outputs')
+    args = parser.parse_args(argv)
+
+    run(args.variables, range(args.years[0], args.years[1]+1), data_dir=args.data_dir,
+        out_dir=args.out_dir, max_workers=args.workers, overwrite=args.overwrite)
+
+if __name__ == '__main__':
+    main()
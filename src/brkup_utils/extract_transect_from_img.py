@@ -4,7 +4,9 @@ Created on Tue Sep 05 2022
 """
 
 import scipy.ndimage
+from scipy.spatial import cKDTree
 import numpy as np
+import xarray as xr
 
 def extract_transect_from_img(xa, xy_pts, num, mode='nearest'):
     """
@@ -37,4 +39,134 @@ def extract_transect_from_img(xa, xy_pts, num, mode='nearest'):
     # Extract the values along the line, using cubic interpolation
     zi = scipy.ndimage.map_coordinates(z.values, np.vstack((x,y)), mode=mode, output=z.dtype)
 
-    return zi
\ No newline at end of file
+    return zi
+
+class Transects:
+    """
+    Sampling coordinates of several transects across an image. The 
+    coordinates are computed once and can be used to sample any number of
+    variables and time steps
+    """
+
+    def __init__(self, xy_pts, num, dx=1.):
+        """
+        Parameters:
+        -----------
+        xy_pts: array (ntransects, 4) of (x0,y0,x1,y1)
+            start and end points in _pixel_ coordinates (x along the last 
+            dimension, y along the second to last dimension)
+        num: number of points along each transect
+        dx: grid spacing, used for the distance along the transects (default pixels)
+        """
+        xy_pts = np.atleast_2d(np.asarray(xy_pts, dtype=float))
+        self.xy_pts = xy_pts
+        self.num = num
+
+        s = np.linspace(0, 1, num)
+        self.x = xy_pts[:, [0]] + s*(xy_pts[:, [2]] - xy_pts[:, [0]]) # (ntransects, num)
+        self.y = xy_pts[:, [1]] + s*(xy_pts[:, [3]] - xy_pts[:, [1]])
+
+        length = np.hypot(xy_pts[:, 2] - xy_pts[:, 0], xy_pts[:, 3] - xy_pts[:, 1])
+        self.distance = dx*length[:, np.newaxis]*s
+
+    @classmethod
+    def from_lonlat(cls, lon, lat, lonlat_pts, num, dx=1.):
+        """
+        Transects from start and end points in longitude and latitude. Each 
+        point is moved to the nearest grid cell (KD-tree on the unit sphere)
+
+        Parameters:
+        -----------
+        lon, lat: 2d arrays (y, x) of grid longitude and latitude
+        lonlat_pts: array (ntransects, 4) of (lon0,lat0,lon1,lat1)
+        num: number of points along each transect
+        dx: grid spacing
+        """
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        lonlat_pts = np.atleast_2d(np.asarray(lonlat_pts, dtype=float))
+
+        tree = cKDTree(_lonlat_to_xyz(lon.ravel(), lat.ravel()))
+        pts = lonlat_pts.reshape(-1, 2)
+        _, idx = tree.query(_lonlat_to_xyz(pts[:, 0], pts[:, 1]))
+        iy, ix = np.unravel_index(idx, lon.shape)
+
+        xy_pts = np.column_stack((ix, iy)).reshape(-1, 4)
+        return cls(xy_pts, num, dx=dx)
+
+    def sample(self, xa, time_chunk=100, order=1, min_valid=0.5, mode='nearest'):
+        """
+        Sample all transects at all time steps. NaN's (land) are not set to 
+        zero: the valid-data mask is interpolated with the data, values are 
+        normalised by it, and points where it is below min_valid are NaN
+
+        Parameters:
+        -----------
+        xa: xarray.DataArray (time, y, x) or (y, x)
+        time_chunk: number of time steps sampled in one call
+        order: spline order of the interpolation (0: nearest, 1: linear)
+        min_valid: minimum fraction of valid data around a point
+        mode: how points outside the image are handled (see ndimage.map_coordinates)
+
+        Returns:
+        --------
+        zi : xarray.DataArray (time, transect, distance)
+        """
+        no_time = xa.ndim == 2
+        if no_time:
+            xa = xa.expand_dims('time')
+        tdim = xa.dims[0]
+        nt = xa.shape[0]
+        ntr = self.x.shape[0]
+
+        zi = np.empty((nt, ntr, self.num), dtype=np.float64)
+        for t0 in range(0, nt, time_chunk):
+            z = np.asarray(xa[t0:t0+time_chunk].values, dtype=np.float64)
+            ntc = z.shape[0]
+            valid = ~np.isnan(z)
+
+            coords = np.stack(np.broadcast_arrays(np.arange(ntc)[:, None, None], 
+                                                  self.y[None], self.x[None])).reshape(3, -1)
+            zs = scipy.ndimage.map_coordinates(np.where(valid, z, 0), coords, order=order, mode=mode)
+            ws = scipy.ndimage.map_coordinates(valid.astype(np.float64), coords, order=order, mode=mode)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                zc = np.where(ws >= min_valid, zs/ws, np.nan)
+            zi[t0:t0+ntc] = zc.reshape(ntc, ntr, self.num)
+
+        zi = xr.DataArray(zi, dims=(tdim, 'transect', 'distance'), 
+                          coords={'along':(('transect', 'distance'), self.distance)},
+                          name=xa.name, attrs=xa.attrs)
+        if tdim in xa.coords:
+            zi = zi.assign_coords({tdim:xa[tdim].values})
+        if no_time:
+            zi = zi.isel({tdim:0}, drop=True)
+
+        return zi
+
+def extract_transects(xa, xy_pts, num, lonlat=False, time_chunk=100, order=1, dx=1.):
+    """
+    Extract several transects at all time steps
+    
+    Parameters:
+    -----------
+    xa: xarray.DataArray (time, y, x)
+    xy_pts: array (ntransects, 4) of (x0,y0,x1,y1) in _pixel_ coordinates, 
+        or (lon0,lat0,lon1,lat1) if lonlat is True
+    num: number of points to interpolate onto
+    lonlat: bool
+        endpoints are longitude and latitude (xa needs 'longitude' and 'latitude' coordinates)
+    
+    Returns:
+    --------
+    zi : xarray.DataArray (time, transect, distance)
+    """
+    if lonlat:
+        transects = Transects.from_lonlat(xa['longitude'].values, xa['latitude'].values, xy_pts, num, dx=dx)
+    else:
+        transects = Transects(xy_pts, num, dx=dx)
+
+    return transects.sample(xa, time_chunk=time_chunk, order=order)
+
+def _lonlat_to_xyz(lon, lat):
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)))
@@ -3,6 +3,9 @@ Created on Fri Sep 16 2022
 @authors: Jonathan Rheinlænder
 """
 
+import numpy as np
+import xarray as xr
+
 def get_slp_gradient(da, point0, point1):
     """
     
@@ -22,18 +25,71 @@ def get_slp_gradient(da, point0, point1):
     
     print('start point:', (point0), '\n', 'end point:', (point1))
     
-    # convert longitude from 0:360 to -180:180
-    da.coords['longitude'] = (da.coords['longitude'] + 180) % 360 - 180
-    da = da.sortby(da.longitude)
+    return get_slp_gradients(da, [[point0, point1]]).isel(pair=0, drop=True)
 
-    end_point = da.sel(longitude=str(point1[0]),
-                       latitude=str(point1[1]),
-                       method="nearest")
+def get_nearest_index(lon, lat, points):
+    """
+    Index of the nearest grid longitude and latitude of each point. 
+    Longitudes are compared modulo 360, so the grid can be 0:360 or -180:180
     
-    start_point = da.sel(longitude=str(point0[0]),
-                         latitude=str(point0[1]),
-                         method="nearest")
+    Parameters:
+    -----------
+    lon : array of grid longitudes (1d)
+    lat : array of grid latitudes (1d)
+    points : array (npoints, 2) of (longitude,latitude)
+        
+    Returns:
+    --------
+    ilon, ilat : arrays (npoints)
+    """
+    points = np.asarray(points, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+
+    dlon = (lon[np.newaxis, :] - points[:, 0, np.newaxis] + 180) % 360 - 180
+    ilon = np.abs(dlon).argmin(axis=1)
+    ilat = np.abs(lat[np.newaxis, :] - points[:, 1, np.newaxis]).argmin(axis=1)
+
+    return ilon, ilat
+
+def get_slp_gradients(da, pairs, names=None):
+    """
     
-    diff = start_point - end_point
+    Calculate difference in pressure between the start and end point of
+    several point pairs. The nearest grid points are found once and all
+    pairs are extracted with a single isel, without modifying da
+    
+    Parameters:
+    -----------
+    da : dataArray with longitude and latitude dimensions
+    pairs : array (npairs, 2, 2) of [start point, end point] with points (longitude,latitude)
+    names : list(str)
+        names of the pairs, e.g. ['BH', 'Fram']. Default is 0, 1, ...
+        
+    Returns:
+    --------
+    diff : dataArray with a 'pair' dimension
+        difference between start and end point of each pair
+    """
+    pairs = np.asarray(pairs, dtype=float)
+    npairs = pairs.shape[0]
+    if names is None:
+        names = np.arange(npairs)
+
+    ilon, ilat = get_nearest_index(da.longitude.values, da.latitude.values, pairs.reshape(-1, 2))
+
+    dims = ('pair', 'end')
+    points = da.isel(longitude=xr.DataArray(ilon.reshape(npairs, 2), dims=dims),
+                     latitude=xr.DataArray(ilat.reshape(npairs, 2), dims=dims))
+
+    diff = points.isel(end=0, drop=True) - points.isel(end=1, drop=True)
+
+    # grid points actually used
+    lon = ((da.longitude.values[ilon] + 180) % 360 - 180).reshape(npairs, 2)
+    lat = da.latitude.values[ilat].reshape(npairs, 2)
+    diff = diff.drop_vars(['longitude', 'latitude'], errors='ignore')
+    diff = diff.assign_coords(pair=names,
+                              lon0=('pair', lon[:, 0]), lat0=('pair', lat[:, 0]),
+                              lon1=('pair', lon[:, 1]), lat1=('pair', lat[:, 1]))
 
-    return diff
\ No newline at end of file
+    return diff
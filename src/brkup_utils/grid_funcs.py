@@ -7,11 +7,15 @@ Created on Thu Dec 09 2021
 
 # Load modules
 from netCDF4 import Dataset
+from scipy.io import netcdf_file
 from pynextsim.projection_info import ProjectionInfo
 import os
 import numpy as np
 from brkup_utils.boxnames import *
 
+# grid fields already computed, shared by all CREGgrid instances: {(grid_dir, bbox, name): array}
+_GRID_CACHE = {}
+
 def get_xy(nlon, nlat):
     """
     
@@ -35,7 +39,7 @@ def get_xy(nlon, nlat):
 class CREGgrid:
     "Class for loading variables from the CREG grid"
     
-    def __init__(self, grid_dir, bbox=None):
+    def __init__(self, grid_dir, bbox=None, persist=False, mmap=False):
         """Initialize object from path
          Parameters:
         -----------
@@ -43,6 +47,15 @@ class CREGgrid:
         
         bbox :  list(float)
             can use this to reduce the grid [xmin, xmax, ymin, ymax]  
+        
+        persist : bool
+            save computed depth and area as .npz next to the grid files 
+            and reuse them in later sessions
+        
+        mmap : bool
+            memory-map the grid files instead of reading them with netCDF4. 
+            Only works for uncompressed NetCDF3 files (e.g. CREG025.L75_byte_mask.nc), 
+            other files are read with netCDF4
         """
         
         grid_list = ['CREG025.L75_byte_mask.nc', 'CREG025.L75_mesh_hgr.nc', 'CREG025.L75_mesh_zgr.nc']       
@@ -50,14 +63,23 @@ class CREGgrid:
         self.mod_grid_f, self.mod_hgr_f, self.mod_zgr_f = [os.path.join(
             grid_dir,ncf) for ncf in grid_list]
         
+        self.grid_dir = os.path.abspath(grid_dir)
         self.bbox = bbox    
+        self.persist = persist
+        self.mmap = mmap
     
     #@staticmethod
-    def get_var_from_netcdf(self, ncfil, varlist):
+    def get_var_from_netcdf(self, ncfil, varlist, surface=False):
         """
+        Only the bbox window (and only the surface level if surface=True) is 
+        read from the file
+        
         Parameters:
         -----------
         varlist : list(str) variable names
+        surface : bool
+            read only the first level of 4D (t,z,y,x) variables. The level
+            dimension is kept with length 1
         
         Returns:
         --------
@@ -65,15 +87,44 @@ class CREGgrid:
         """
         #print(ncfil, varlist)
         
+        if self.mmap:
+            try:
+                with netcdf_file(ncfil, mode='r', mmap=True) as nc:
+                    return [self.read_window(nc.variables[var], surface) for var in varlist]
+            except TypeError: # not a NetCDF3 file
+                pass
+        
         with Dataset(ncfil) as nc:
-            varout = [np.array(nc.variables[var]) for var in varlist]
-
-            # reduce grid with bbox
-            if self.bbox is not None: 
-                varout = self.reduce_2dgrid(varout)
+            varout = [self.read_window(nc.variables[var], surface) for var in varlist]
 
         return varout
     
+    def read_window(self, ncvar, surface=False):
+        """
+        Read a hyperslab of a NetCDF variable: bbox over the last 2-dim (y,x) 
+        of 3D and 4D variables, and the first level of 4D variables if surface=True
+        
+        Parameters:
+        -----------
+        ncvar : netCDF4.Variable or scipy.io.netcdf_variable
+        
+        Returns:
+        --------
+        arr : (array)
+        """
+        ndim = len(ncvar.shape)
+        idx = [slice(None)]*ndim
+        
+        if self.bbox is not None and ndim in (3, 4):
+            [x0, x1, y0, y1] = self.bbox
+            idx[-2] = slice(y0, y1)
+            idx[-1] = slice(x0, x1)
+            
+        if surface and ndim==4:
+            idx[1] = slice(0, 1)
+        
+        return np.array(ncvar[tuple(idx)])
+    
     def reduce_2dgrid(self, varlist):
         """
         Apply boundary box 'bbox'
@@ -97,10 +148,39 @@ class CREGgrid:
             else: varout.append(arr)
         return varout
     
+    def cached(self, name, func):
+        """
+        Returns grid field 'name' computed by 'func' from the memory cache, 
+        the .npz file (if persist=True) or by calling 'func'
+        """
+        bbox = None if self.bbox is None else tuple(int(b) for b in self.bbox)
+        key = (self.grid_dir, bbox, name)
+        
+        if key not in _GRID_CACHE:
+            bbox_str = 'full' if bbox is None else '_'.join(str(b) for b in bbox)
+            npz_file = os.path.join(self.grid_dir, f'CREG025_{name}_{bbox_str}.npz')
+            
+            if self.persist and os.path.isfile(npz_file):
+                with np.load(npz_file) as npz:
+                    _GRID_CACHE[key] = npz[name]
+            else:
+                _GRID_CACHE[key] = func()
+                if self.persist:
+                    try:
+                        np.savez(npz_file, **{name:_GRID_CACHE[key]})
+                    except OSError as err:
+                        print('Could not save', npz_file, err)
+        
+        # return a copy so that callers can modify the array
+        return _GRID_CACHE[key].copy()
+    
     def get_area(self):
         """Returns grid cell area (in m2) for the CREG grid. Land is nan"""
+        return self.cached('area', self.calc_area)
+    
+    def calc_area(self):
         e1t, e2t = self.get_var_from_netcdf(self.mod_hgr_f, ['e1t', 'e2t'])
-        tmask = self.get_var_from_netcdf(self.mod_grid_f, ['tmask'])[0]
+        tmask = self.get_var_from_netcdf(self.mod_grid_f, ['tmask'], surface=True)[0]
         
         tmask = np.squeeze(tmask[0,0,:,:])
         e1t = np.squeeze(e1t[0,:])
@@ -115,15 +195,15 @@ class CREGgrid:
 
     def get_depth(self):
         """Returns depth (in m) for the CREG grid"""
-        
+        return self.cached('depth', self.calc_depth)
+    
+    def calc_depth(self):
         mod_depth = self.get_var_from_netcdf(self.mod_zgr_f, ['gdept_1d'])
         mbathy = self.get_var_from_netcdf(self.mod_zgr_f, ['mbathy'])
 
         mod_depth = np.squeeze(mod_depth)
         mbathy = np.squeeze(mbathy)
         
-        depth = np.zeros(np.shape(mbathy))
-        for i in range(0,np.shape(depth)[0]):
-            for j in range(0,np.shape(depth)[1]):
-                depth[i,j] = mod_depth[mbathy[i,j]]
+        # look up depth of the bottom level for all grid points at once
+        depth = mod_depth[mbathy.astype(int)].astype(float)
         return depth
\ No newline at end of file
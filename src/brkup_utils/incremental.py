@@ -0,0 +1,206 @@
+## Incremental update of derived mooring products
+"""
+Keeps a manifest of the mooring files that went into a stored product
+(lead fraction, deformation, growth budget, regional means, ...). When the
+product is updated only new or changed months are processed and appended
+along time. If an earlier file changed the product is recomputed from
+that file onwards.
+"""
+
+import os
+import json
+import hashlib
+from functools import partial
+import numpy as np
+import xarray as xr
+from brkup_utils.boxnames import *
+from brkup_utils.process_data import _select_bbox, mooring_files
+from brkup_utils.store_funcs import write_store
+
+#########################################################
+class IncrementalProduct:
+    "Derived time series stored as NetCDF or Zarr together with a manifest of its input files"
+
+    def __init__(self, store, func, params=None, use_hash=False):
+        """
+        Parameters:
+        -----------
+        store : (str) output file, '.zarr' for a Zarr store, otherwise NetCDF
+        func : function
+            computes the product from a mooring dataset, ds_out = func(ds).
+            The output must have a time dimension
+        params : dict
+            settings of the product (e.g. region, thresholds). The product
+            is recomputed from scratch when they change
+        use_hash : bool
+            also compare a sha1 hash of the file contents, not only mtime and size
+        """
+        self.store = store
+        self.func = func
+        self.params = params if params is not None else {}
+        self.use_hash = use_hash
+        self.manifest_file = store + '.manifest.json'
+        self.is_zarr = store.endswith('.zarr')
+
+    def file_record(self, fl):
+        """Identity of an input file (mtime, size and optionally hash)"""
+        st = os.stat(fl)
+        record = {'mtime_ns':st.st_mtime_ns, 'size':st.st_size}
+        if self.use_hash:
+            sha1 = hashlib.sha1()
+            with open(fl, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha1.update(block)
+            record['sha1'] = sha1.hexdigest()
+        return record
+
+    def load_manifest(self):
+        if not os.path.isfile(self.manifest_file) or not os.path.exists(self.store):
+            return None
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        tmpfile = self.manifest_file + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmpfile, self.manifest_file)
+
+    def plan(self, files):
+        """
+        Files to process
+
+        Parameters:
+        -----------
+        files : list(str) input files in time order
+
+        Returns:
+        --------
+        first : int
+            index of the first file to (re)process, len(files) if nothing to do
+        truncate : (str) or None
+            time from which the stored product must be replaced, None if
+            the new files are only appended
+        """
+        manifest = self.load_manifest()
+        if manifest is None or manifest['params'] != json.loads(json.dumps(self.params)):
+            return 0, None
+
+        stored = manifest['files']
+        paths = [os.path.abspath(fl) for fl in files]
+        if any(path not in paths for path in stored):
+            print('input files were removed, recomputing', self.store)
+            return 0, None
+
+        # first file that is new or changed
+        first = len(paths)
+        for i, path in enumerate(paths):
+            if path not in stored or self.is_changed(path, stored[path]):
+                first = i
+                break
+        if first == 0:
+            return 0, None
+
+        # stored data from files at or after 'first' must be replaced
+        later = [stored[path]['time'] for path in paths[first:] if path in stored]
+        return first, min(later) if later else None
+
+    def is_changed(self, path, record):
+        record = {key:val for key, val in record.items() if key != 'time'}
+        changed = record != self.file_record(path)
+        if changed:
+            print('changed:', path)
+        return changed
+
+    def update(self, files, region=None, parallel=False):
+        """
+        Process new or changed files and extend the stored product
+
+        Parameters:
+        -----------
+        files : list(str) input mooring files in time order
+        region : (str) region to subset from BOXNAMES
+        parallel : bool
+            open the files in parallel
+
+        Returns:
+        --------
+        ds : xarray.Dataset complete product
+        """
+        manifest = self.load_manifest()
+        first, truncate = self.plan(files)
+        todo = files[first:]
+        if not todo and truncate is None:
+            print('up to date:', self.store)
+            return self.open()
+
+        print('processing', len(todo), 'of', len(files), 'files')
+        if todo:
+            preprocess = partial(_select_bbox, bbox=BOXNAMES[region]) if region is not None else None
+            ds = xr.open_mfdataset(todo, concat_dim="time", combine="nested",
+                                   data_vars='minimal', coords='minimal', compat='override',
+                                   parallel=parallel, preprocess=preprocess)
+            new = self.func(ds).load()
+            ds.close()
+        else:
+            new = None
+
+        if first == 0:
+            self.write(new)
+        elif truncate is None:
+            self.append(new)
+        else:
+            print('replacing product from', truncate)
+            self.replace_from(truncate, new)
+
+        # manifest is only written once the product is complete
+        stored = manifest['files'] if manifest is not None and first > 0 else {}
+        records = {}
+        for fl in files:
+            path = os.path.abspath(fl)
+            if fl in todo or path not in stored:
+                record = self.file_record(fl)
+                with xr.open_dataset(fl) as ds_fl:
+                    record['time'] = str(ds_fl.time.values[0])
+                records[path] = record
+            else:
+                records[path] = stored[path]
+        self.save_manifest({'params':self.params, 'files':records})
+
+        return self.open()
+
+    def open(self):
+        if self.is_zarr:
+            return xr.open_zarr(self.store)
+        return xr.open_dataset(self.store)
+
+    def write(self, ds):
+        """Write the product under a temporary name and move it in place"""
+        if self.is_zarr:
+            write_store(ds, self.store)
+        else:
+            write_store(ds, self.store, unlimited_dims=['time'])
+
+    def append(self, new):
+        """Append new time steps to the product"""
+        if self.is_zarr:
+            # store is modified in place: an interrupted append means a full recompute
+            if os.path.isfile(self.manifest_file):
+                os.remove(self.manifest_file)
+            for var in new.variables:
+                new[var].encoding = {}
+            new.to_zarr(self.store, append_dim='time')
+        else:
+            with xr.open_dataset(self.store) as old:
+                ds = xr.concat([old.load(), new], dim='time', data_vars='minimal',
+                               coords='minimal', compat='override')
+            self.write(ds)
+
+    def replace_from(self, time, new):
+        """Drop the product from 'time' onwards and append new"""
+        with self.open() as old:
+            keep = old.sel(time=old.time < np.datetime64(time)).load()
+        ds = keep if new is None else xr.concat([keep, new], dim='time', data_vars='minimal',
+                                                coords='minimal', compat='override')
+        self.write(ds)
+
@@ -84,4 +84,175 @@ def map_leads(ds, case_name, clim):
 
     leadmask = leadmask.where(landmask==1)
     
-    return leadfrac, leadmask
\ No newline at end of file
+    return leadfrac, leadmask
+
+LEAD_METHODS = ["breakup_paper", "Olason2021", "Willmes2019", "Martin2004", "open-water"]
+
+def map_leads_batch(ds, methods=LEAD_METHODS, thresholds=[0.05]):
+    """
+    Evaluate several lead detection methods and cut-off values in one pass. 
+    Intermediate fields (open water fraction, slab thickness, land mask) are 
+    computed once and shared by all methods. Works lazily on dask arrays.
+    
+    Parameters:
+    -----------
+    ds : xarray.DataSet
+    methods : list(str)
+        case names from LEAD_METHODS (see map_leads)
+    thresholds: list(float)
+        cut-off values. Not used by Martin2004 (leadfrac>0)
+        
+    Returns:
+    --------
+    leadfrac: fraction of the grid cell characterized as a lead. Dimensions: (method, ...)
+    leadmask: boolean mask (0=not a lead or 1=lead, nan over land). Dimensions: (method, threshold, ...)
+    """
+    for case_name in methods:
+        if case_name not in LEAD_METHODS:
+            raise ValueError("Unknown case name:", case_name)
+    
+    clim = xr.DataArray(np.asarray(thresholds, dtype=float), dims='threshold', 
+                        coords={'threshold':thresholds})
+    
+    # shared intermediates
+    owfraction = 1 - ds['sic']
+    sic_thin = ds['sic_thin']
+    hthin = ds['sit_thin']/sic_thin # slab ice thickness
+    landmask = ds['sit'].notnull()
+    
+    leadfrac = []
+    leadmask = []
+    for case_name in methods:
+        if (case_name == "breakup_paper"):
+            frac = owfraction + sic_thin
+            mask = frac > clim
+            
+        elif (case_name=="Olason2021"):
+            hslab = hthin.where(sic_thin>0, other=0) # slab thickness is zero if sic_thin is also zero
+            frac = owfraction + sic_thin.where(hslab<=0.1, other=0) # exclude ice that is thicker than 10 cm
+            mask = frac > clim
+        
+        elif (case_name=="Willmes2019"):
+            frac = hthin.where(hthin<=0.2, other=0) # exclude ice that is thicker than 20 cm
+            mask = frac > clim
+            
+        elif (case_name=="Martin2004"):
+            frac = hthin.where(hthin<0.1, other=0)
+            mask = (frac > 0) & (clim == clim) # same mask for all thresholds
+            
+        elif (case_name=="open-water"):
+            frac = owfraction
+            mask = frac >= clim
+        
+        leadfrac.append(frac)
+        leadmask.append(mask.transpose('threshold', ...))
+    
+    method = xr.DataArray(methods, dims='method', name='method')
+    leadfrac = xr.concat(leadfrac, dim=method, coords='minimal', compat='override')
+    leadmask = xr.concat(leadmask, dim=method, coords='minimal', compat='override')
+    
+    # apply land mask
+    leadmask = leadmask.where(landmask)
+    
+    return leadfrac, leadmask
+
+
+# number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class PackedLeadMask:
+    """
+    Lead mask stored with one bit per grid cell (np.packbits along x) and a 
+    separate land mask shared by all time steps. Uses 64x less memory than 
+    the float leadmask from map_leads.
+    """
+    
+    def __init__(self, bits, landmask, time, coords=None):
+        """
+        Parameters:
+        -----------
+        bits : np.ndarray(uint8)
+            packed lead mask (time, y, ceil(x/8))
+        landmask : xarray.DataArray
+            boolean (y, x) mask, True over ocean
+        time : array of time values
+        coords : dict
+            spatial coordinates of the lead mask (e.g. longitude, latitude)
+        """
+        self.bits = bits
+        self.landmask = landmask
+        self.time = time
+        self.coords = coords
+    
+    @classmethod
+    def from_leadmask(cls, leadmask, landmask=None, time_chunk=100):
+        """
+        Pack a leadmask (time, y, x) from map_leads, one chunk of time steps at a time
+        
+        Parameters:
+        -----------
+        leadmask : xarray.DataArray
+            0=not a lead, 1=lead, nan over land
+        landmask : xarray.DataArray
+            True over ocean. Default is where the first time step of leadmask is not nan
+        time_chunk : int
+            number of time steps loaded at once
+        """
+        if landmask is None:
+            landmask = leadmask.isel(time=0, drop=True).notnull()
+        
+        nt = leadmask.sizes['time']
+        bits = []
+        for t0 in range(0, nt, time_chunk):
+            vals = leadmask.isel(time=slice(t0, t0+time_chunk)).transpose('time', 'y', 'x').values
+            bits.append(np.packbits(vals==1, axis=-1))
+        
+        coords = {k:v for k,v in leadmask.coords.items() if 'time' not in v.dims}
+        return cls(np.concatenate(bits), landmask.transpose('y', 'x'), leadmask.time.values, coords)
+    
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.landmask.values.nbytes
+    
+    def as_uint8(self):
+        """Lead mask as uint8 (time, y, x) DataArray: 1=lead, 0=no lead or land"""
+        nx = self.landmask.sizes['x']
+        vals = np.unpackbits(self.bits, axis=-1, count=nx)
+        return xr.DataArray(vals, dims=('time', 'y', 'x'), 
+                            coords=dict(time=self.time, **self.coords), name='leadmask')
+    
+    def unpack(self):
+        """Lead mask as returned by map_leads: float, nan over land"""
+        return self.as_uint8().where(self.landmask)
+    
+    def area_fraction(self, masks):
+        """
+        Lead area fraction in each region, computed directly from the packed bits.
+        Same as leadmask.where(mask).mean(dim=('x','y')) 
+        
+        Parameters:
+        -----------
+        masks : dict(name:mask) or mask
+            region masks (y, x) (1 or True inside the region)
+        
+        Returns:
+        --------
+        laf : xarray.DataArray (time, region) or (time) for a single mask
+        """
+        single = not isinstance(masks, dict)
+        if single:
+            masks = {'region':masks}
+        
+        ocean = np.asarray(self.landmask, dtype=bool)
+        laf = np.empty((len(self.time), len(masks)))
+        for i, mask in enumerate(masks.values()):
+            region = (np.asarray(mask)==1) & ocean
+            packed_region = np.packbits(region, axis=-1)
+            nleads = _POPCOUNT[self.bits & packed_region].sum(axis=(1, 2), dtype=np.int64)
+            laf[:, i] = nleads/region.sum() if region.any() else np.nan
+        
+        laf = xr.DataArray(laf, dims=('time', 'region'), 
+                           coords={'time':self.time, 'region':list(masks.keys())}, name='laf')
+        if single:
+            laf = laf.isel(region=0, drop=True)
+        return laf
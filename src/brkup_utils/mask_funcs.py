@@ -7,7 +7,10 @@ Modified from Guillaume Boutin `/pytwin/gb_funcs.py`
 from pynextsim.projection_info import ProjectionInfo
 from netCDF4 import Dataset, num2date, date2num
 import numpy as np
-import matplotlib.pyplot as plt
+import os
+import hashlib
+import threading
+from scipy.spatial import cKDTree
 from brkup_utils.boxnames import *
 from brkup_utils.grid_funcs import *
 
@@ -25,9 +28,212 @@ from brkup_utils.grid_funcs import *
 NANUK_GRIDDIR = '/home/rheinlender/shared-simstore-ns9829k/NANUK/NANUK025-I/'
 NSIDC_GRIDDIR = '/home/rheinlender/Data/NSIDC/NSIDC_25km_grid.nc'
 
+# NSIDC grid projected on the NSIDC projection and region outlines, loaded/computed once per file
+_NSIDC_GRID = {}
+_NSIDC_PATHS = {}
+_NSIDC_LOCK = threading.Lock()
+
+# rasterized masks for each model grid: {grid key: {region index: mask}}
+_MASK_CACHE = {}
+
+def get_nsidc_grid(nsidc_file=None):
+    """
+    Returns x, y (on the NSIDC projection) and region mask of the NSIDC grid
+    in nsidc_file (default NSIDC_GRIDDIR)
+    """
+    if nsidc_file is None:
+        nsidc_file = NSIDC_GRIDDIR
+    with _NSIDC_LOCK:
+        grid = _NSIDC_GRID.setdefault(os.path.abspath(nsidc_file), {})
+        if not grid:
+            # The projection used by NSIDC
+            map = ProjectionInfo.osisaf_nsidc_np_stere().pyproj
+            #  The grid lon,lat and mask
+            with Dataset(nsidc_file, mode='r') as ncm:
+                masks_nsidc = np.array(ncm["mask"][:])
+                lon_nsidc   = ncm["lon"][:]
+                lat_nsidc   = ncm["lat"][:]
+                x_nsidc, y_nsidc = map(lon_nsidc,lat_nsidc)
+            
+            grid.update(x=np.array(x_nsidc), y=np.array(y_nsidc), mask=masks_nsidc)
+    
+    return grid['x'], grid['y'], grid['mask']
+
+def get_nsidc_tree(nsidc_file=None):
+    """KD-tree over the projected NSIDC grid points"""
+    x_nsidc, y_nsidc, _ = get_nsidc_grid(nsidc_file)
+    grid = _NSIDC_GRID[os.path.abspath(nsidc_file if nsidc_file is not None else NSIDC_GRIDDIR)]
+    with _NSIDC_LOCK:
+        if 'tree' not in grid:
+            grid['tree'] = cKDTree(np.column_stack((x_nsidc.ravel(), y_nsidc.ravel())))
+    return grid['tree']
+
+def nearest_nsidc_labels(x, y, max_dist=None, nsidc_file=None):
+    """
+    Label each grid point with the NSIDC region index of the nearest NSIDC 
+    grid cell. Does not use matplotlib, so it is safe to call from parallel workers
+    
+    Parameters:
+    -----------
+    x : numpy.ndarray
+        x array for grid (on the NSIDC projection)
+    y : numpy.ndarray
+        y array for grid
+    max_dist : float
+        points further than max_dist (m) from any NSIDC grid point get label 0
+    nsidc_file : (str)
+        NSIDC grid file (default NSIDC_GRIDDIR)
+    
+    Returns:
+    --------
+    labels : integer array with the same shape as x
+    """
+    x=np.array(x) ; y=np.array(y)
+    _, _, masks_nsidc = get_nsidc_grid(nsidc_file)
+    
+    dist, idx = get_nsidc_tree(nsidc_file).query(np.column_stack((x.ravel(), y.ravel())))
+    labels = masks_nsidc.ravel()[idx].astype(np.int16)
+    if max_dist is not None:
+        labels[dist > max_dist] = 0
+    
+    return labels.reshape(x.shape)
+
+def get_nsidc_paths(index_region, nsidc_file=None):
+    """
+    Returns all outlines (matplotlib.path.Path) of a NSIDC region, 
+    including islands and holes
+    """
+    key = (os.path.abspath(nsidc_file if nsidc_file is not None else NSIDC_GRIDDIR), index_region)
+    if key not in _NSIDC_PATHS:
+        x_nsidc, y_nsidc, masks_nsidc = get_nsidc_grid(nsidc_file)
+        
+        # I want an array with 0s everywhere but within the region I am interested
+        mask_nsidc=np.zeros(masks_nsidc.shape)
+        mask_nsidc[masks_nsidc==index_region]=1
+        
+        # use matplotlib to find the contour of region, one Path per ring
+        import matplotlib.pyplot as plt
+        from matplotlib.path import Path
+        rings = plt.contour(x_nsidc,y_nsidc,mask_nsidc,[0.5]).allsegs[0]
+        _NSIDC_PATHS[key] = [Path(ring) for ring in rings]
+        plt.close()
+    
+    return _NSIDC_PATHS[key]
+
+class MaskRegistry():
+    "Rasterized NSIDC region masks for one model grid, computed once and kept on disk"
+    
+    def __init__(self, x, y, bbox=None, cache_dir=None, method='nearest', nsidc_file=None):
+        """
+        Parameters:
+        -----------
+        x : numpy.ndarray
+            x array for grid
+        y : numpy.ndarray
+            y array for grid
+        bbox :  list(float)
+            [xmin, xmax, ymin, ymax] of the grid
+        cache_dir : (str)
+            directory where the masks are stored. If None the masks are only 
+            kept in memory
+        method : (str)
+            'nearest': label of the nearest NSIDC grid cell (all regions at once)
+            'contour': inside the matplotlib contours of each region
+        nsidc_file : (str)
+            NSIDC grid file with the regions (default NSIDC_GRIDDIR)
+        """
+        if method not in ('nearest', 'contour'):
+            raise ValueError("Unknown method:", method)
+        
+        self.x = np.array(x)
+        self.y = np.array(y)
+        self.method = method
+        self.nsidc_file = nsidc_file
+        
+        # key identifying the model grid
+        sha = hashlib.sha1(self.x.astype(np.float64).tobytes())
+        sha.update(self.y.astype(np.float64).tobytes())
+        sha.update(str(bbox).encode())
+        sha.update(method.encode())
+        if nsidc_file is not None:
+            sha.update(os.path.abspath(nsidc_file).encode())
+        self.key = sha.hexdigest()[:16]
+        
+        self.cache_file = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_file = os.path.join(cache_dir, f'nsidc_masks_{self.key}.npz')
+        
+        # region index -> mask, or 'labels' -> label map
+        self.masks = _MASK_CACHE.setdefault(self.key, {})
+        if not self.masks and self.cache_file is not None and os.path.isfile(self.cache_file):
+            with np.load(self.cache_file) as npz:
+                self.masks.update({(int(k[1:]) if k.startswith('r') else k):npz[k] for k in npz.files})
+    
+    def save(self):
+        if self.cache_file is not None:
+            np.savez_compressed(self.cache_file, 
+                                **{(f'r{k}' if isinstance(k, int) else k):v for k,v in self.masks.items()})
+    
+    def get_mask(self, index_region):
+        """Returns boolean mask of region 'index_region' on the model grid"""
+        if self.method == 'nearest':
+            return self.get_labels() == index_region
+        
+        if index_region not in self.masks:
+            self.masks[index_region] = rasterize_paths(get_nsidc_paths(index_region, self.nsidc_file), self.x, self.y)
+            self.save()
+        return self.masks[index_region].copy()
+    
+    def get_labels(self, regions=None):
+        """
+        Bulk mode: integer label map of all regions (default all of 
+        NSIDC_region_dic), 0 outside the regions
+        """
+        if self.method == 'nearest':
+            if 'labels' not in self.masks:
+                self.masks['labels'] = nearest_nsidc_labels(self.x, self.y, nsidc_file=self.nsidc_file)
+                self.save()
+            labels = self.masks['labels'].copy()
+            if regions is not None:
+                labels[~np.isin(labels, list(regions))] = 0
+            return labels
+        
+        if regions is None:
+            regions = NSIDC_region_dic.values()
+        
+        missing = [r for r in regions if r not in self.masks]
+        for index_region in missing:
+            self.masks[index_region] = rasterize_paths(get_nsidc_paths(index_region, self.nsidc_file), self.x, self.y)
+        if missing:
+            self.save()
+        
+        labels = np.zeros(self.x.shape, dtype=np.int16)
+        for index_region in regions:
+            labels[self.masks[index_region]] = index_region
+        return labels
+
+def rasterize_paths(paths, x, y):
+    """
+    Mask of the points (x, y) inside the outlines 'paths'. Compound paths are 
+    split into their rings, points inside an even number of rings (holes) 
+    are outside
+    """
+    from matplotlib.path import Path
+    x=np.array(x) ; y=np.array(y)
+    coords = np.array([x.ravel(), y.ravel()]).transpose()
+    
+    mask_1d = np.zeros(x.size, dtype=bool)
+    for path in paths:
+        for ring in path.to_polygons():
+            mask_1d ^= Path(ring).contains_points(coords)
+    
+    return mask_1d.reshape(x.shape)
+
 class Masking():
     
-    def __init__(self, dataset, bbox=None):
+    def __init__(self, dataset, bbox=None, cache_dir=None, method='nearest', 
+                 grid_dir=NANUK_GRIDDIR, nsidc_file=None):
         """
         Parameters:
         -----------
@@ -35,9 +241,27 @@ class Masking():
         
         bbox :  list(float)
             can use this to reduce the grid [xmin, xmax, ymin, ymax]   
+        
+        cache_dir : (str)
+            directory where rasterized NSIDC masks are stored (see MaskRegistry)
+        
+        method : (str)
+            how NSIDC regions are rasterized: 'nearest' (KD-tree lookup, default) 
+            or 'contour' (matplotlib outlines)
+        
+        grid_dir : (str)
+            NANUK grid directory used by the depth and box masks
+        
+        nsidc_file : (str)
+            NSIDC grid file with the regions (default NSIDC_GRIDDIR)
         """ 
         self.dataset=dataset  
         self.bbox=bbox
+        self.cache_dir=cache_dir
+        self.method=method
+        self.grid_dir=grid_dir
+        self.nsidc_file=nsidc_file
+        self.registry=None
         self.check_latlon_2d()
 
     def check_latlon_2d(self):
@@ -77,10 +301,7 @@ class Masking():
         else:
             raise ValueError("Unknown region name:", mask_name)       
         
-        # get x-y coordinates of nextsim grid
-        x, y = get_xy(self.dataset.longitude, self.dataset.latitude)
-    
-        mask_box = self.calculate_mask(x,y,index_region)
+        mask_box = self.get_registry().get_mask(index_region)
         
         
         if depth is not None:
@@ -92,12 +313,25 @@ class Masking():
         
         return {"data":mask_box,"name":mask_name}
     
+    def get_registry(self):
+        """MaskRegistry for the grid of the dataset"""
+        if self.registry is None:
+            # get x-y coordinates of nextsim grid
+            x, y = get_xy(self.dataset.longitude, self.dataset.latitude)
+            self.registry = MaskRegistry(x, y, bbox=self.bbox, cache_dir=self.cache_dir,
+                                         method=self.method, nsidc_file=self.nsidc_file)
+        return self.registry
+    
+    def get_nsidc_labels(self):
+        """Integer map with the NSIDC region index (NSIDC_region_dic) of each grid cell"""
+        return self.get_registry().get_labels()
+    
     def mask_depth(self, mask_box, depth):
         
         """Mask areas that are shallower than 'depth'"""
         
         # get model depth from CREG
-        creg = CREGgrid(NANUK_GRIDDIR, self.bbox)
+        creg = CREGgrid(self.grid_dir, self.bbox)
         mdepth = creg.get_depth()
         
         # check that dimensions fit
@@ -129,43 +363,11 @@ class Masking():
         """ 
         
         ####n  -> Choose the region you want to select with its index
-        # The projection used by NSIDC
-        map = ProjectionInfo.osisaf_nsidc_np_stere().pyproj
-        #  The grid lon,lat and mask
-        with Dataset(NSIDC_GRIDDIR, mode='r') as ncm:
-            masks_nsidc = ncm["mask"][:]
-            lon_nsidc   = ncm["lon"][:]
-            lat_nsidc   = ncm["lat"][:]
-            x_nsidc,y_nsidc= map(lon_nsidc,lat_nsidc)  
-
-        # I want an array with 0s everywhere but within the region I am interested
-        mask_nsidc=np.zeros(masks_nsidc.shape)
-        mask_nsidc[masks_nsidc==index_region]=1
-
-        # Project model lon, lat on the nsidc projection and get 1d vector out of them
-        x=np.array(x) ; y=np.array(y)
-        Nx     = x.size
-        shp    = x.shape
-        x_1d   = x.reshape(Nx)
-        y_1d   = y.reshape(Nx)
-
-        # use matplotlib to find the contour of region
-        all_paths = plt.contour(x_nsidc,y_nsidc,mask_nsidc,[0.5]).collections[0].get_paths()
-        plt.close()
-        
-        # look for the biggest contour : WARNING, I might forget some little bits by doing that, I haven't checked too carefully
-        max_len=0
-        for i in range(len(all_paths)):
-            if len(all_paths[i])>max_len:
-                max_len=len(all_paths[i])
-                bbPath=all_paths[i]
-        
-        # select all the indexes that are within the (biggest) contour of my region
-        coords = np.array([x_1d,y_1d]).transpose()
-        mask_1d= np.array(bbPath.contains_points(coords),dtype=bool)
+        # all the contours of the region (computed once per session)
+        all_paths = get_nsidc_paths(index_region, self.nsidc_file)
         
-        # Back to 2d
-        mask   = mask_1d.reshape(shp)
+        # select all the indexes that are within the contours of my region
+        mask = rasterize_paths(all_paths, x, y)
         
         return mask
     
@@ -175,7 +377,7 @@ class Masking():
         lon = self.dataset.longitude
         
         # get land/ocean mask from CREG
-        creg = CREGgrid(NANUK_GRIDDIR, self.bbox)
+        creg = CREGgrid(self.grid_dir, self.bbox)
         mod_area = creg.get_area()
         tmask = ~np.isnan(mod_area)  
         
@@ -192,7 +394,7 @@ class Masking():
         lon = self.dataset.longitude
         
         # get land/ocean mask from CREG
-        creg = CREGgrid(NANUK_GRIDDIR, self.bbox)
+        creg = CREGgrid(self.grid_dir, self.bbox)
         mod_area = creg.get_area()
         tmask = ~np.isnan(mod_area)  
         
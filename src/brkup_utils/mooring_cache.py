@@ -0,0 +1,127 @@
+## On-disk cache of processed mooring subsets
+
+import os
+import json
+import shutil
+import hashlib
+import xarray as xr
+from brkup_utils.store_funcs import write_store
+
+#########################################################
+class MooringCache:
+    "Content-addressed Zarr cache of regional, time-averaged mooring datasets"
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Parameters:
+        -----------
+        cache_dir : (str) directory where the Zarr stores are kept
+        max_size : (float)
+            maximum size of the cache in bytes. When exceeded, the least
+            recently used stores are removed. None means no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(files, region=None, months=None, years=None, period=None):
+        """
+        Key for a cache entry. Changes whenever one of the input files is
+        modified (mtime/size) or the selection/averaging changes
+
+        Parameters:
+        -----------
+        files : list(str) input mooring files
+        region : (str) region from BOXNAMES
+        months : list
+        years : list
+        period : (str) averaging period
+
+        Returns:
+        --------
+        key : (str) hexadecimal hash
+        """
+        stats = []
+        for fl in files:
+            st = os.stat(fl)
+            stats.append([os.path.abspath(fl), st.st_mtime_ns, st.st_size])
+
+        content = dict(files=stats, region=region,
+                       months=[str(m) for m in months] if months is not None else None,
+                       years=[int(y) for y in years] if years is not None else None,
+                       period=period)
+
+        return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.zarr')
+
+    def get(self, key):
+        """Returns the cached dataset for 'key' or None if it is not in the cache"""
+        store = self.path(key)
+        if not os.path.isdir(store):
+            return None
+
+        print('reading from cache', store)
+        os.utime(store) # mark as recently used
+        return xr.open_zarr(store)
+
+    def put(self, key, ds, chunks=None):
+        """
+        Write dataset to the cache and return it re-opened from the Zarr store
+
+        Parameters:
+        -----------
+        key : (str) from make_key
+        ds : xarray.Dataset
+        chunks : dict
+            chunking of the Zarr store. Default is automatic chunks along 
+            time and one chunk along the other dimensions
+        """
+        store = self.path(key)
+        if chunks is None:
+            chunks = {dim:-1 for dim in ds.dims}
+            if 'time' in ds.dims:
+                chunks['time'] = 'auto'
+
+        print('writing to cache', store)
+        write_store(ds.chunk(chunks), store) # only complete stores end up in the cache
+
+        self.evict(keep=key)
+
+        return xr.open_zarr(store)
+
+    def size(self, key=None):
+        """Size in bytes of one entry or of the whole cache"""
+        root = self.path(key) if key is not None else self.cache_dir
+        total = 0
+        for dirpath, _, filenames in os.walk(root):
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+        return total
+
+    def entries(self):
+        """Cache entries sorted from least to most recently used"""
+        stores = [f for f in os.listdir(self.cache_dir) if f.endswith('.zarr')]
+        stores.sort(key=lambda f: os.path.getmtime(os.path.join(self.cache_dir, f)))
+        return [f[:-len('.zarr')] for f in stores]
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache is below max_size"""
+        if self.max_size is None:
+            return
+
+        sizes = {key: self.size(key) for key in self.entries()}
+        total = sum(sizes.values())
+        for key, size in sizes.items():
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            print('removing from cache', self.path(key))
+            shutil.rmtree(self.path(key))
+            total -= size
+
+    def clear(self):
+        for key in self.entries():
+            shutil.rmtree(self.path(key))
@@ -8,9 +8,13 @@ Created on Thu Dec 09 2021
 # Load modules
 from netCDF4 import Dataset
 from string import Template
+from functools import partial
 from pynextsim.openers import OpenerVariable, Opener
 from pynextsim.gmshlib import GmshMesh
 import os
+import numpy as np
+import pandas as pd
+import xarray as xr
 
 # set environment
 os.environ['INPUT_OBS_DATA_DIR'] = '/home/rheinlender/shared-simstore-ns9829k/data/'
@@ -31,11 +35,93 @@ class OpenerEra5(Opener):
                 }
         
         
+    # resolved file names {(varname, year): path} and grids {path: (lon, lat)}, shared by all openers
+    _files = dict()
+    _lonlat = dict()
+
+    @staticmethod
     def get_lonlat(file):
+        """Returns longitude and latitude of an ERA5 file (read once and cached)"""
+        if file not in OpenerEra5._lonlat:
+            with Dataset(file) as ds:
+                lon = np.array(ds['longitude'][:])
+                lat = np.array(ds['latitude'][:])
+            OpenerEra5._lonlat[file] = (lon, lat)
+
+        return OpenerEra5._lonlat[file]
+
+    def get_filename(self, year):
+        """File for one year (resolved once)"""
+        key = (self.varname, year)
+        if key not in self._files:
+            dto = pd.Timestamp(year=year, month=1, day=1).to_pydatetime()
+            self._files[key] = os.path.join(os.environ['INPUT_OBS_DATA_DIR'], dto.strftime(self.name_mask))
+        return self._files[key]
+
+    @staticmethod
+    def get_bbox_index(lon, lat, bbox):
+        """
+        Index of the ERA5 grid within bbox [lonmin, lonmax, latmin, latmax] (degrees)
+        """
+        [lon0, lon1, lat0, lat1] = bbox
+        ilat = np.where((lat >= lat0) & (lat <= lat1))[0]
+
+        lon = np.mod(lon, 360.)
+        lon0, lon1 = np.mod(lon0, 360.), np.mod(lon1, 360.)
+        if lon0 <= lon1:
+            ilon = np.where((lon >= lon0) & (lon <= lon1))[0]
+            ilon = slice(ilon.min(), ilon.max()+1)
+        else: # crosses 0E
+            ilon = np.concatenate([np.where(lon >= lon0)[0], np.where(lon <= lon1)[0]])
+
+        return slice(ilat.min(), ilat.max()+1), ilon
+
+    @classmethod
+    def open_range(cls, variables, start, end, bbox=None, chunks={'time':-1}, parallel=True):
+        """
+        Open several ERA5 variables over several years as one lazy dataset
         
-        with Dataset(file) as ds:
+        Parameters:
+        -----------
+        variables : list(str) e.g. ['u10', 'v10', 'msl']
+        start, end : (str) or datetime, e.g. '2000-01-01', '2018-12-31'
+        bbox : list(float)
+            [lonmin, lonmax, latmin, latmax] (degrees) to subset while opening
+        chunks : dict
+            dask chunks
+        parallel : bool
+            open the files in parallel
         
-            lon = ds['longitude'][:]
-            lat = ds['latitude'][:]
+        Returns:
+        --------
+        ds : xarray.Dataset
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        years = range(start.year, end.year+1)
+
+        datasets = []
+        for varname in variables:
+            files = [cls(varname).get_filename(year) for year in years]
+
+            # static grid is read once, not decoded again from every yearly file
+            lon, lat = cls.get_lonlat(files[0])
+            if bbox is not None:
+                ilat, ilon = cls.get_bbox_index(lon, lat, bbox)
+                lon, lat = lon[ilon], lat[ilat]
+                preprocess = partial(_isel_latlon, ilat=ilat, ilon=ilon)
+            else:
+                preprocess = None
+
+            ds = xr.open_mfdataset(files, concat_dim='time', combine='nested', 
+                                   data_vars='minimal', coords='minimal', compat='override',
+                                   drop_variables=['latitude', 'longitude'], 
+                                   preprocess=preprocess, chunks=chunks, parallel=parallel)
+            datasets.append(ds.assign_coords(latitude=('latitude', lat), longitude=('longitude', lon)))
+
+        ds = xr.merge(datasets, compat='override', join='override')
+        return ds.sel(time=slice(start, end))
+
 
-        return lon, lat    
\ No newline at end of file
+def _isel_latlon(ds, ilat, ilon):
+    """Preprocess hook for open_mfdataset: select ERA5 grid window"""
+    return ds.isel(latitude=ilat, longitude=ilon)    
\ No newline at end of file
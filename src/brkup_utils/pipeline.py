@@ -0,0 +1,154 @@
+## Parallel per-year execution of mooring analyses
+"""
+Splits an analysis into shards of one year (or one month) of moorings,
+runs the shards in separate processes (or on a local dask cluster) with
+a memory limit per worker and merges the results along time
+
+Example:
+    def lead_fraction(ds):
+        leadfrac, _ = lead_detect.map_leads(ds, 'breakup_paper', 0.05)
+        return leadfrac.mean(dim=('x', 'y')).to_dataset(name='leadfrac')
+
+    ds = run_pipeline(lead_fraction, indir, years=range(2000, 2019),
+                      months=['01', '02', '03'], region='Beaufort', max_workers=8)
+
+The analysis function must be defined at module level so it can be
+sent to the worker processes. Workers are started with 'spawn', so in a
+script the call must be under `if __name__ == '__main__':`.
+"""
+
+import os
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import xarray as xr
+from brkup_utils import process_data
+
+SHARD_BY = ['year', 'year-month']
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+#########################################################
+def get_shards(years, months, by='year'):
+    """
+    Parameters:
+    -----------
+    years : list(int)
+    months : list(str) e.g. ['01', '02', '03']
+    by : (str) 'year' or 'year-month'
+
+    Returns:
+    --------
+    shards : list of (years, months) in time order
+    """
+    if by == 'year':
+        return [([year], list(months)) for year in years]
+    elif by == 'year-month':
+        return [([year], [month]) for year in years for month in months]
+    raise ValueError("Unknown shard type:", by)
+
+def init_worker(memory_limit=None, threads=1):
+    """
+    Worker initializer: limit the address space of the process to
+    memory_limit bytes and the number of dask threads. OpenMP/BLAS threads 
+    are limited by worker_env, before numpy is imported in the worker
+    """
+    if memory_limit is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+
+    import dask
+    dask.config.set(scheduler='threads', num_workers=threads)
+
+@contextmanager
+def worker_env(threads=1):
+    """
+    Set the OpenMP/BLAS thread variables while workers are started, so the 
+    spawned processes see them when they import numpy
+    """
+    old = {var:os.environ.get(var) for var in THREAD_VARS}
+    os.environ.update({var:str(threads) for var in THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, val in old.items():
+            if val is None:
+                os.environ.pop(var)
+            else:
+                os.environ[var] = val
+
+def run_shard(func, indir, years, months, region=None, period=None, func_kwargs=None):
+    """Load one shard of moorings, apply func and return the result in memory"""
+    ds = process_data.load_moorings(indir, months, years, region=region, period=period,
+                                    pushdown=region is not None)
+    out = func(ds, **(func_kwargs or {}))
+    if isinstance(out, xr.DataArray):
+        out = out.to_dataset()
+    out = out.load()
+    ds.close()
+    return out
+
+def run_pipeline(func, indir, years, months, region=None, period=None, by='year',
+                 func_kwargs=None, max_workers=None, memory_limit=None, threads=1,
+                 backend='processes', concat_dim='time', outfile=None):
+    """
+    Run func on every shard of moorings in parallel and merge the results
+
+    Parameters:
+    -----------
+    func : function
+        analysis, out = func(ds, **func_kwargs), returning a Dataset or named DataArray
+    indir : (str) input directory
+    years : list(int)
+    months : list(str)
+    region : (str) region to subset from BOXNAMES
+    period : (str) time averaging (see process_data.load_moorings)
+    by : (str) 'year' or 'year-month'
+    func_kwargs : dict
+        keyword arguments of func
+    max_workers : int
+        number of worker processes. Default is the number of cores
+    memory_limit : float
+        memory limit of each worker in bytes
+    threads : int
+        threads per worker
+    backend : (str)
+        'processes' (concurrent.futures) or 'dask' (dask.distributed LocalCluster)
+    concat_dim : (str) dimension to merge the shards along
+    outfile : (str)
+        write the merged result to NetCDF, or Zarr if it ends with '.zarr'
+
+    Returns:
+    --------
+    ds : xarray.Dataset
+    """
+    shards = get_shards(years, months, by=by)
+    args = [(func, indir, yrs, mons, region, period, func_kwargs) for yrs, mons in shards]
+    print('running', len(shards), 'shards on', backend)
+
+    if backend == 'processes':
+        with worker_env(threads), ProcessPoolExecutor(max_workers=max_workers, 
+                mp_context=multiprocessing.get_context('spawn'), initializer=init_worker,
+                initargs=(memory_limit, threads)) as executor:
+            futures = [executor.submit(run_shard, *arg) for arg in args]
+            results = [future.result() for future in futures]
+
+    elif backend == 'dask':
+        from dask.distributed import LocalCluster, Client
+        with worker_env(threads), LocalCluster(n_workers=max_workers, threads_per_worker=threads,
+                          memory_limit=memory_limit if memory_limit is not None else 'auto',
+                          processes=True) as cluster, Client(cluster) as client:
+            futures = [client.submit(run_shard, *arg, pure=False) for arg in args]
+            results = client.gather(futures)
+    else:
+        raise ValueError("Unknown backend:", backend)
+
+    ds = xr.concat(results, dim=concat_dim, data_vars='minimal', coords='minimal', compat='override')
+
+    if outfile is not None:
+        if outfile.endswith('.zarr'):
+            ds.to_zarr(outfile, mode='w')
+        else:
+            ds.to_netcdf(outfile)
+        print('Saved', outfile)
+
+    return ds
@@ -6,12 +6,22 @@ Created on Fri Nov 12 2021
 
 import xarray as xr
 import numpy as np
+from functools import partial
+from netCDF4 import Dataset
 from brkup_utils.boxnames import *
+from brkup_utils.mooring_cache import MooringCache
+from brkup_utils.time_reduce import StreamingReducer, PERIODS
 
 #########################################################
+def mooring_files(indir, months, years):
+    """Mooring files of the given years and months, in time order"""
+    return [f"{indir}/{year}/nextsim/Moorings_{year}m{month}.nc" for year in years for month in months]
+
 #class LoadDataset():
     
-def load_moorings(indir, months, years, region=None, period=None):
+def load_moorings(indir, months, years, region=None, period=None,
+                  pushdown=False, parallel=False, cache_dir=None, cache_size=None,
+                  stream=False):
     """
     Parameters:
     -----------
@@ -21,6 +31,22 @@ def load_moorings(indir, months, years, region=None, period=None):
     region : (str) region to subset from BOXNAMES 
     period : pandas.datetime offset alias (str) 
         period to average over, e.g. 'D' (daily)
+    pushdown : bool
+        if True the region bbox is applied to each file as it is opened 
+        and dask chunks are aligned with the on-disk NetCDF chunking, 
+        so only the bytes of the box are read
+    parallel : bool
+        open and preprocess the files in parallel (dask.delayed)
+    cache_dir : (str)
+        directory of the Zarr cache. If given, the subsetted and averaged 
+        dataset is stored there and reused as long as the input files 
+        and arguments are unchanged
+    cache_size : (float)
+        maximum size of the cache in bytes (least recently used entries are removed)
+    stream : bool
+        if True and period is one of 'daily', 'monthly', 'year-month' or 'season', 
+        the averages are computed file by file with StreamingReducer 
+        (bounded memory) and the result is loaded in memory
 
     Returns:
     --------
@@ -42,14 +68,44 @@ def load_moorings(indir, months, years, region=None, period=None):
         print("years:", years)
 
     ###### READ NEXTSIM DATA
-    files = [f"{indir}/{year}/nextsim/Moorings_{year}m{month}.nc" for year in years for month in months]
-
-    ds=xr.open_mfdataset(files, concat_dim="time", combine="nested",
-                      data_vars='minimal', coords='minimal', compat='override')
+    files = mooring_files(indir, months, years)
+
+    if cache_dir is not None:
+        cache = MooringCache(cache_dir, max_size=cache_size)
+        key = cache.make_key(files, region, months, years, period)
+        ds = cache.get(key)
+        if ds is not None:
+            print('DONE!')
+            return ds
+
+    if stream and period in PERIODS:
+        ##### STREAMING TIME AVERAGE
+        preprocess = None
+        if region is not None:
+            print("bbox for", region, ':', BOXNAMES[region])
+            preprocess = partial(_select_bbox, bbox=BOXNAMES[region])
+
+        print('calculating', period, 'average')
+        ds = StreamingReducer(period).reduce(files, preprocess=preprocess)
+        period = None # already averaged
+
+    elif pushdown and region is not None:
+        ##### SUBSET REGION WHILE READING
+        print("bbox for", region, ':', BOXNAMES[region])
+        chunks = get_disk_chunks(files[0])
+        chunks['time'] = -1 # one dask chunk in time per monthly file
+        ds=xr.open_mfdataset(files, concat_dim="time", combine="nested",
+                          data_vars='minimal', coords='minimal', compat='override',
+                          chunks=chunks, parallel=parallel,
+                          preprocess=partial(_select_bbox, bbox=BOXNAMES[region]))
+    else:
+        ds=xr.open_mfdataset(files, concat_dim="time", combine="nested",
+                          data_vars='minimal', coords='minimal', compat='override',
+                          parallel=parallel)
 
-    ##### SUBSET REGION
-    if region is not None:
-        ds = subset_data_region(ds, region)
+        ##### SUBSET REGION
+        if region is not None:
+            ds = subset_data_region(ds, region)
 
     ##### average in time
     if period is not None:
@@ -59,6 +115,9 @@ def load_moorings(indir, months, years, region=None, period=None):
         else:
             ds = time_average(ds, period)
 
+    if cache_dir is not None:
+        ds = cache.put(key, ds)
+
     print('DONE!')
 
     return ds
@@ -75,6 +134,40 @@ def subset_data_region(ds, region=None):
     sel = ds.sel(x=slice(x1, x2), y=slice(y1, y2))
     return sel
 
+def _select_bbox(ds, bbox):
+    """Preprocess hook for open_mfdataset: select bbox [x1, x2, y1, y2] from a single file"""
+    [x1, x2, y1, y2] = bbox
+    return ds.sel(x=slice(x1, x2), y=slice(y1, y2))
+
+def get_disk_chunks(ncfile):
+    """
+    Get the on-disk chunk sizes of a NetCDF file
+    
+    Parameters:
+    -----------
+    ncfile : (str) path to NetCDF file
+    
+    Returns:
+    --------
+    chunks : dict 
+        chunk size for each dimension, e.g. {'time':1, 'y':603, 'x':528}.
+        Contiguous (unchunked) dimensions are read as one chunk (-1)
+    """
+    chunks = {}
+    with Dataset(ncfile) as nc:
+        for var in nc.variables.values():
+            chunking = var.chunking()
+            if chunking == 'contiguous' or chunking is None:
+                continue
+            for dim, size in zip(var.dimensions, chunking):
+                # keep the smallest chunk found for each dimension
+                chunks[dim] = min(size, chunks.get(dim, size))
+
+        for dim in nc.dimensions:
+            chunks.setdefault(dim, -1)
+
+    return chunks
+
 def time_average(ds, period):
     print('calculating time average')
     sel = ds.resample(time=period).mean(dim='time')
@@ -0,0 +1,190 @@
+## Regional time series of nextsim moorings
+"""
+Area-weighted means, sums and fractions of many variables over many
+regions, computed with one sparse matrix product per time chunk instead
+of a .where(mask).mean() pass per region and variable
+"""
+
+import numpy as np
+import xarray as xr
+import scipy.sparse as sp
+from brkup_utils.boxnames import BOXNAMES, NSIDC_region_dic
+
+REGION_STATS = ['mean', 'sum', 'fraction', 'area']
+
+#########################################################
+class RegionReducer:
+    """
+    Sparse (region, grid cell) matrix of area weights. Each row holds the
+    cell areas of one region, so regions may overlap
+    """
+
+    def __init__(self, labels, area=None, names=None):
+        """
+        Parameters:
+        -----------
+        labels : array (y, x) of int
+            region label of each grid cell, 0 is no region
+        area : array (y, x)
+            grid cell area (e.g. CREGgrid.get_area()). NaN (land) cells are
+            left out. Default is equal weights
+        names : dict
+            {region name: label}. Default is all labels > 0, named by label
+        """
+        labels = np.asarray(labels)
+        if names is None:
+            names = {int(label):int(label) for label in np.unique(labels) if label > 0}
+
+        masks = {name:labels == label for name, label in names.items()}
+        self._build(masks, area)
+
+    @classmethod
+    def from_masks(cls, masks, area=None):
+        """
+        Reducer from possibly overlapping region masks
+
+        Parameters:
+        -----------
+        masks : dict {region name: mask (y, x) of 1/0 or bool}
+        area : array (y, x) grid cell area
+        """
+        reducer = cls.__new__(cls)
+        reducer._build(masks, area)
+        return reducer
+
+    def _build(self, masks, area):
+        self.regions = list(masks.keys())
+        self.shape = np.shape(next(iter(masks.values())))
+        ncell = int(np.prod(self.shape))
+
+        if area is None:
+            area = np.ones(self.shape)
+        area = np.asarray(area, dtype=np.float64).ravel()
+        area = np.where(np.isnan(area), 0, area)
+
+        rows, cols, vals = [], [], []
+        for i, mask in enumerate(masks.values()):
+            idx = np.flatnonzero(np.asarray(mask).ravel() == 1)
+            idx = idx[area[idx] > 0]
+            rows.append(np.full(idx.size, i))
+            cols.append(idx)
+            vals.append(area[idx])
+
+        self.weights = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(len(self.regions), ncell))
+        self.region_area = np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def reduce(self, ds, variables=None, stats=['mean'], threshold=0., time_chunk=100):
+        """
+        Regional statistics of all variables, one sparse product per time chunk
+
+        Parameters:
+        -----------
+        ds : xarray.Dataset or DataArray with dimensions (time, y, x)
+        variables : list(str)
+            default is all variables with dimensions (time, y, x)
+        stats : list(str)
+            'mean' : area-weighted mean over the valid (not NaN) cells
+            'sum' : area integral, e.g. m2 for a lead mask
+            'fraction' : area fraction of the valid cells where the variable > threshold
+            'area' : area of the valid cells
+        threshold : float
+            threshold for 'fraction'
+        time_chunk : int
+            number of time steps loaded at once
+
+        Returns:
+        --------
+        out : xarray.Dataset with variables '{var}' (mean) or '{var}_{stat}',
+            dimensions (time, region)
+        """
+        for stat in stats:
+            if stat not in REGION_STATS:
+                raise ValueError("Unknown statistic:", stat)
+
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name=ds.name or 'var')
+        if variables is None:
+            variables = [var for var in ds.data_vars if set(ds[var].dims) == {'time', 'y', 'x'}]
+
+        nt = ds.sizes['time']
+        nreg = len(self.regions)
+        # terms per variable: sum(a*v), sum(a*valid), sum(a*(v>threshold))
+        sums = np.zeros((3, len(variables), nreg, nt))
+
+        for t0 in range(0, nt, time_chunk):
+            block = ds[variables].isel(time=slice(t0, t0+time_chunk)).transpose('time', 'y', 'x').load()
+            ntc = block.sizes['time']
+
+            columns = []
+            for var in variables:
+                vals = block[var].values.reshape(ntc, -1).astype(np.float64)
+                valid = ~np.isnan(vals)
+                columns += [np.where(valid, vals, 0), valid, valid & (vals > threshold)]
+
+            # (ncell, 3*nvar*ntc) and a single sparse product for all variables
+            cols = np.concatenate(columns, axis=0).T
+            res = self.weights @ cols
+            sums[..., t0:t0+ntc] = res.reshape(nreg, len(variables), 3, ntc).transpose(2, 1, 0, 3)
+
+        data_vars = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i, var in enumerate(variables):
+                total, valid_area, above = sums[0, i], sums[1, i], sums[2, i]
+                out = {'mean':np.where(valid_area > 0, total/valid_area, np.nan),
+                       'sum':total,
+                       'fraction':np.where(valid_area > 0, above/valid_area, np.nan),
+                       'area':valid_area}
+                for stat in stats:
+                    name = var if stat == 'mean' else var + '_' + stat
+                    data_vars[name] = (('time', 'region'), out[stat].T)
+
+        coords = {'time':ds['time'].values, 'region':self.regions,
+                  'region_area':('region', self.region_area)}
+        return xr.Dataset(data_vars, coords=coords)
+
+#########################################################
+def get_box_masks(boxes=None, shape=None, bbox=None):
+    """
+    Masks of index boxes on the nextsim grid (BOXNAMES)
+
+    Parameters:
+    -----------
+    boxes : dict {name: [x1, x2, y1, y2]}. Default is BOXNAMES
+    shape : tuple (ny, nx) of the grid
+    bbox : list [x1, x2, y1, y2]
+        box the grid was cut from (e.g. BOXNAMES[region]). Default is the full grid
+
+    Returns:
+    --------
+    masks : dict {name: bool array (y, x)}
+    """
+    if boxes is None:
+        boxes = BOXNAMES
+    x0, y0 = (0, 0) if bbox is None else (bbox[0], bbox[2])
+
+    masks = {}
+    for name, [x1, x2, y1, y2] in boxes.items():
+        mask = np.zeros(shape, dtype=bool)
+        mask[max(y1-y0, 0):max(y2-y0, 0), max(x1-x0, 0):max(x2-x0, 0)] = True
+        masks[name] = mask
+    return masks
+
+def get_nsidc_reducer(masking, area=None, regions=None):
+    """
+    RegionReducer for the NSIDC regions on the grid of a Masking object
+
+    Parameters:
+    -----------
+    masking : mask_funcs.Masking
+    area : array (y, x) grid cell area
+    regions : list(str) names from NSIDC_region_dic. Default is all regions
+
+    Returns:
+    --------
+    RegionReducer
+    """
+    if regions is None:
+        regions = NSIDC_region_dic.keys()
+    names = {name:NSIDC_region_dic[name] for name in regions}
+    return RegionReducer(masking.get_nsidc_labels(), area=area, names=names)
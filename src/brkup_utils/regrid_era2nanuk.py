@@ -3,18 +3,259 @@ Created on Fri Sep 16 2022
 @authors: Jonathan Rheinlænder
 """
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, date2num
+import os
+import shutil
 import numpy as np
-from scipy.interpolate import RectBivariateSpline
+from scipy import sparse
 import datetime as dt
 import xarray as xr
 from openerEra5 import OpenerEra5
+from brkup_utils.store_funcs import replace_store
 
-def regrid_era2nanuk(era_file, mooring_file, dates=None):    
+
+REGRID_METHODS = ['bilinear', 'nearest', 'conservative']
+
+class Regridder:
+    """
+    Interpolation from a regular lat/lon grid (ERA5) to the NANUK grid, 
+    stored as a sparse matrix (e.g. 4 weights per model cell for bilinear). 
+    The weights are computed once and applied to all time steps and 
+    variables as one matrix product.
+    """
+    
+    def __init__(self, lat_e, lon_e, lat_m, lon_m, weights=None, method='bilinear', nsub=5):
+        """
+        Parameters:
+        -----------
+        lat_e, lon_e : 1d arrays with ERA5 latitude and longitude (any order)
+        lat_m, lon_m : 2d arrays with model latitude and longitude
+        weights : scipy.sparse matrix (model cells, ERA5 cells)
+            precomputed weights. Computed if None
+        method : (str)
+            'bilinear', 'nearest' or 'conservative'. 'conservative' samples each 
+            model cell with nsub x nsub points and weights the ERA5 cells by the 
+            fraction of the model cell they cover (first-order area-conservative)
+        nsub : int
+            number of sub-points per direction for 'conservative'
+        """
+        if method not in REGRID_METHODS:
+            raise ValueError("Unknown method:", method)
+        
+        self.lat_e = np.asarray(lat_e, dtype=np.float64)
+        self.lon_e = np.asarray(lon_e, dtype=np.float64)
+        self.lat_m = np.asarray(lat_m, dtype=np.float64)
+        self.lon_m = np.asarray(lon_m, dtype=np.float64)
+        self.method = method
+        self.nsub = nsub
+        
+        if weights is None:
+            weights = self.compute_weights()
+        self.weights = weights.tocsr()
+    
+    def matches(self, lat_e, lon_e, lat_m, lon_m, method='bilinear', nsub=5):
+        """True if the regridder was made for these grids and method"""
+        if self.method != method or (method == 'conservative' and self.nsub != nsub):
+            return False
+        grids = [(self.lat_e, lat_e), (self.lat_m, lat_m), 
+                 (np.mod(self.lon_e, 360.), np.mod(lon_e, 360.)), 
+                 (np.mod(self.lon_m, 360.), np.mod(lon_m, 360.))]
+        for mine, other in grids:
+            other = np.asarray(other, dtype=np.float64)
+            if mine.shape != other.shape or not np.allclose(mine, other):
+                return False
+        return True
+    
+    @staticmethod
+    def _axis_weights(coord, points, periodic=False):
+        """
+        Indices (into 'coord') of the two neighbours of each point and the weight 
+        of the second neighbour
+        """
+        order = np.argsort(coord)
+        c = coord[order]
+        n = len(c)
+        
+        if periodic: # append first point after the last one
+            points = c[0] + np.mod(points - c[0], 360.)
+            c = np.append(c, c[0] + 360.)
+        
+        i0 = np.clip(np.searchsorted(c, points, side='right') - 1, 0, len(c) - 2)
+        w1 = np.clip((points - c[i0])/(c[i0+1] - c[i0]), 0, 1)
+        
+        return order[i0 % n], order[(i0 + 1) % n], w1
+    
+    def compute_weights(self):
+        """Sparse matrix (model cells, ERA5 cells) of interpolation weights"""
+        lat_m = self.lat_m.ravel()
+        lon_m = self.lon_m.ravel()
+        ncell = lat_m.size
+        
+        if self.method == 'conservative':
+            # sub-points of each model cell, each representing the same fraction of the cell
+            lat_m, lon_m = get_cell_subpoints(self.lat_m, self.lon_m, self.nsub)
+            rows = np.repeat(np.arange(ncell), self.nsub**2)
+            lat_m = lat_m.ravel()
+            lon_m = lon_m.ravel()
+        else:
+            rows = np.arange(ncell)
+        
+        lon_m = np.mod(lon_m, 360.) # longitude from 0-->360 
+        lon_e = np.mod(self.lon_e, 360.)
+        nlon = len(lon_e)
+        
+        # longitude is periodic if the grid covers the whole globe
+        dlon = np.median(np.diff(np.sort(lon_e)))
+        periodic = (np.ptp(lon_e) + 1.5*dlon) >= 360.
+        
+        i0, i1, wy = self._axis_weights(self.lat_e, lat_m)
+        j0, j1, wx = self._axis_weights(lon_e, lon_m, periodic=periodic)
+        
+        if self.method == 'bilinear':
+            rows = np.tile(rows, 4)
+            cols = np.concatenate([i0*nlon + j0, i0*nlon + j1, i1*nlon + j0, i1*nlon + j1])
+            vals = np.concatenate([(1-wy)*(1-wx), (1-wy)*wx, wy*(1-wx), wy*wx])
+        else:
+            # ERA5 cell containing the point (cells are centred on the grid points)
+            i = np.where(wy < 0.5, i0, i1)
+            j = np.where(wx < 0.5, j0, j1)
+            cols = i*nlon + j
+            vals = np.full(len(rows), 1./self.nsub**2 if self.method == 'conservative' else 1.)
+        
+        # duplicate entries (several sub-points in the same ERA5 cell) are summed
+        return sparse.csr_matrix((vals, (rows, cols)), shape=(ncell, len(self.lat_e)*nlon))
+    
+    def save(self, fname):
+        """Save grids and weights to .npz"""
+        w = self.weights
+        np.savez(fname, lat_e=self.lat_e, lon_e=self.lon_e, lat_m=self.lat_m, lon_m=self.lon_m,
+                 data=w.data, indices=w.indices, indptr=w.indptr, shape=w.shape,
+                 method=self.method, nsub=self.nsub)
+    
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as npz:
+            weights = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), 
+                                        shape=tuple(npz['shape']))
+            method = str(npz['method']) if 'method' in npz.files else 'bilinear'
+            nsub = int(npz['nsub']) if 'nsub' in npz.files else 5
+            return cls(npz['lat_e'], npz['lon_e'], npz['lat_m'], npz['lon_m'], weights=weights,
+                       method=method, nsub=nsub)
+    
+    def grid_angle(self):
+        """
+        Angle (radians) between the model grid x-axis and the local east direction, 
+        from the direction of the neighbouring grid points along x
+        """
+        def diff_x(f, period=None):
+            # centred difference along x (one-sided at the edges)
+            d = np.empty_like(f)
+            d[..., 1:-1] = f[..., 2:] - f[..., :-2]
+            d[..., 0] = f[..., 1] - f[..., 0]
+            d[..., -1] = f[..., -1] - f[..., -2]
+            if period is not None: # across the dateline
+                d = (d + period/2) % period - period/2
+            return d
+        
+        lat = np.deg2rad(self.lat_m)
+        dlon = np.deg2rad(diff_x(self.lon_m, period=360.))
+        dlat = diff_x(lat)
+        return np.arctan2(dlat, dlon*np.cos(lat))
+    
+    def rotate(self, u, v):
+        """
+        Rotate vector components (..., y, x) from east/north to the model grid x/y axes
+        """
+        angle = self.grid_angle()
+        cosa, sina = np.cos(angle), np.sin(angle)
+        return u*cosa + v*sina, -u*sina + v*cosa
+    
+    def regrid_dataset(self, ds, vector_pairs=None, rotate=True):
+        """
+        Regrid all data variables on the ERA5 grid with the same weights
+        
+        Parameters:
+        -----------
+        ds : xarray.Dataset with (time, latitude, longitude) variables
+        vector_pairs : list(tuple)
+            pairs of vector components, e.g. [('u10', 'v10')]
+        rotate : bool
+            rotate the vector pairs onto the model grid x/y axes
+        
+        Returns:
+        --------
+        data_vars : dict(name: array (time, y, x))
+        """
+        varnames = [var for var in ds.data_vars if ds[var].dims[-2:]==('latitude','longitude')]
+        
+        # stack all variables so they are regridded in one matrix product
+        nt = ds.sizes['time']
+        stacked = np.concatenate([ds[var].values.reshape((nt, -1)) for var in varnames])
+        regridded = self.regrid(stacked.reshape((len(varnames)*nt,) + ds[varnames[0]].shape[-2:]))
+        data_vars = {var:regridded[i*nt:(i+1)*nt] for i, var in enumerate(varnames)}
+        
+        if vector_pairs is not None and rotate:
+            for uname, vname in vector_pairs:
+                data_vars[uname], data_vars[vname] = self.rotate(data_vars[uname], data_vars[vname])
+        
+        return data_vars
+    
+    def regrid(self, var):
+        """
+        Parameters:
+        -----------
+        var : array (..., lat, lon) on the ERA5 grid
+        
+        Returns:
+        --------
+        var_m : array (..., y, x) on the model grid
+        """
+        var = np.asarray(var)
+        lead = var.shape[:-2]
+        flat = var.reshape((-1, var.shape[-2]*var.shape[-1]))
+        var_m = (self.weights @ flat.T).T
+        return var_m.reshape(lead + self.lat_m.shape)
+
+def get_cell_subpoints(lat_m, lon_m, nsub):
+    """
+    nsub x nsub points evenly distributed within each model cell. The cell 
+    corners are the means of the 4 surrounding cell centres (computed in 3D 
+    cartesian coordinates, so it works across the dateline and near the pole)
+    
+    Returns:
+    --------
+    lat, lon : arrays (y*x, nsub*nsub)
+    """
+    lat = np.deg2rad(lat_m)
+    lon = np.deg2rad(lon_m)
+    xyz = np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+    
+    # extrapolate centres by one cell on each side
+    xyz = np.concatenate([2*xyz[:1] - xyz[1:2], xyz, 2*xyz[-1:] - xyz[-2:-1]], axis=0)
+    xyz = np.concatenate([2*xyz[:, :1] - xyz[:, 1:2], xyz, 2*xyz[:, -1:] - xyz[:, -2:-1]], axis=1)
+    corners = 0.25*(xyz[:-1, :-1] + xyz[1:, :-1] + xyz[:-1, 1:] + xyz[1:, 1:])
+    
+    c00 = corners[:-1, :-1].reshape((-1, 1, 3))
+    c01 = corners[:-1, 1:].reshape((-1, 1, 3))
+    c10 = corners[1:, :-1].reshape((-1, 1, 3))
+    c11 = corners[1:, 1:].reshape((-1, 1, 3))
+    
+    frac = (np.arange(nsub) + 0.5)/nsub
+    b, a = [f.reshape((1, -1, 1)) for f in np.meshgrid(frac, frac, indexing='ij')] # a along x, b along y
+    pts = (1-a)*(1-b)*c00 + a*(1-b)*c01 + (1-a)*b*c10 + a*b*c11
+    pts /= np.linalg.norm(pts, axis=-1, keepdims=True)
+    
+    lat_s = np.rad2deg(np.arcsin(np.clip(pts[..., 2], -1, 1)))
+    lon_s = np.rad2deg(np.arctan2(pts[..., 1], pts[..., 0]))
+    return lat_s, lon_s
+
+
+def regrid_era2nanuk(era_file, mooring_file, dates=None, weights_file=None,
+                     method='bilinear', vector_pairs=None, rotate=True):    
     """
     
     Regrid ERA5 atmospheric data on regular lat/lon grid to NANUK irregular grid (ORCA tripolar)
-    The function uses 'RectBivariateSpline' to interpolate the ERA5 variable to NANUK grid. 
+    The function uses bilinear weights (Regridder) to interpolate the ERA5 variable to NANUK grid. 
     
     Parameters:
     -----------
@@ -22,12 +263,20 @@ def regrid_era2nanuk(era_file, mooring_file, dates=None):
     mooring_file : str
     dates: (str) e.g. '2000-01-01'
        can be used to subset the ERA5 data
+    weights_file : (str)
+       .npz file where the interpolation weights are stored and reused
+    method : (str)
+       'bilinear', 'nearest' or 'conservative' (see Regridder)
+    vector_pairs : list(tuple)
+       pairs of vector components, e.g. [('u10', 'v10')]
+    rotate : bool
+       rotate vector_pairs from east/north onto the local x/y axes of the model grid
         
     Returns:
     --------
     ds_m : xarray.Dataset
     
-        Interpolated variable (time, lat, lon) or (lat, lon).         Same shape as mooring data.
+        Interpolated variables (time, lat, lon) or (lat, lon).         Same shape as mooring data.
     
     """
     
@@ -50,26 +299,14 @@ def regrid_era2nanuk(era_file, mooring_file, dates=None):
     # get time 
     time = ds.time.data
     
-    # get variable name
-    for varname in ds.data_vars:
-        var_e = ds[varname][:,::-1]
-
     # get era5 lat/lon
     lat_e = ds.latitude.values
     lon_e = ds.longitude.values
-    lat_e = lat_e[::-1] # make sure latitude is increasing  
 
-    #print(var_e.shape)
+    # Interpolating all ERA5 variables for all time steps at once
+    regridder = get_regridder(lat_e, lon_e, lat_m, lon_m, weights_file, method)
     
-    # Interpolating ERA5 using RectBivariateSpline
-    var_m = np.empty((var_e.shape[0], lon_m.shape[0], lon_m.shape[1])) # initialize
-    
-    for t in range(var_e.shape[0]): # loop over time dim
-        
-        s = RectBivariateSpline(lat_e, lon_e, var_e[t], kx=1, ky=1)
-
-        var_m_flat = s(lat_m.flatten(), lon_m.flatten(), grid=False)
-        var_m[t::] = np.reshape(var_m_flat, lon_m.shape)
+    var_m = regridder.regrid_dataset(ds, vector_pairs=vector_pairs, rotate=rotate)
     
     ################ convert to dataset ##################
     
@@ -80,8 +317,8 @@ def regrid_era2nanuk(era_file, mooring_file, dates=None):
              }
 
     # define data variables 
-    data_vars={varname:(( "time", "y","x"), var_m)           
-                   } 
+    data_vars={varname:(( "time", "y","x"), var_m[varname])           
+                   for varname in var_m} 
 
     # new dataset
     ds_m = xr.Dataset(
@@ -89,4 +326,146 @@ def regrid_era2nanuk(era_file, mooring_file, dates=None):
         data_vars=data_vars, 
     )
 
-    return ds_m
\ No newline at end of file
+    return ds_m
+
+def regrid_era2nanuk_stream(era_file, mooring_file, outfile, bbox=None, dates=None, 
+                            time_chunk=50, weights_file=None, method='bilinear', 
+                            vector_pairs=None, rotate=True):
+    """
+    
+    Regrid ERA5 to the NANUK grid with bounded memory. ERA5 is cropped to the 
+    lat/lon envelope of the target grid (or of 'bbox'), read lazily 'time_chunk' 
+    time steps at a time, and each regridded chunk is appended to 'outfile'
+    
+    Parameters:
+    -----------
+    era_file : (str)
+    mooring_file : str
+    outfile : (str)
+        output file, NetCDF or Zarr (if it ends with .zarr)
+    bbox :  list(int)
+        reduce the model grid [xmin, xmax, ymin, ymax], e.g. BOXNAMES['Beaufort']
+    dates: (str) e.g. '2000-01-01'
+       can be used to subset the ERA5 data
+    time_chunk : int
+       number of time steps regridded at once
+    weights_file : (str)
+       .npz file where the interpolation weights (for the cropped grids) are stored and reused
+    method, vector_pairs, rotate : 
+       see regrid_era2nanuk
+        
+    Returns:
+    --------
+    outfile : (str)
+    """
+    
+    # get model lat-lon
+    with Dataset(mooring_file) as ds:
+        lon_m = np.array(ds['longitude'][:])
+        lat_m = np.array(ds['latitude'][:])
+    
+    if bbox is not None:
+        [x0, x1, y0, y1] = bbox
+        lon_m = lon_m[y0:y1, x0:x1]
+        lat_m = lat_m[y0:y1, x0:x1]
+    
+    ds = xr.open_dataset(era_file, chunks={'time':time_chunk})
+    if dates is not None:
+        ds = ds.sel(time = slice(dates[0],dates[1]), drop=True)
+    
+    # crop ERA5 to the cells used by the interpolation
+    lat_e = ds.latitude.values
+    lon_e = ds.longitude.values
+    crop = get_era_crop(lat_e, lon_e, lat_m, lon_m, method)
+    ds = ds.isel(latitude=crop[0], longitude=crop[1])
+    
+    regridder = get_regridder(ds.latitude.values, ds.longitude.values, lat_m, lon_m, 
+                              weights_file, method)
+    
+    varnames = [var for var in ds.data_vars if ds[var].dims[-2:]==('latitude','longitude')]
+    
+    print('Regridding', varnames, 'to', outfile)
+    tmpfile = outfile + '.tmp'
+    nt = ds.sizes['time']
+    for t0 in range(0, nt, time_chunk):
+        sel = ds.isel(time=slice(t0, t0+time_chunk))
+        var_m = regridder.regrid_dataset(sel, vector_pairs=vector_pairs, rotate=rotate)
+        data_vars = {var:(("time", "y", "x"), var_m[var].astype(np.float32)) for var in varnames}
+        ds_m = xr.Dataset(data_vars=data_vars, 
+                          coords={'time':sel.time.values,
+                                  'longitude':(('y','x'), lon_m),
+                                  'latitude':(('y','x'), lat_m)})
+        
+        if outfile.endswith('.zarr'):
+            if t0==0:
+                if os.path.isdir(tmpfile):
+                    shutil.rmtree(tmpfile) # left over from an interrupted run
+                ds_m.to_zarr(tmpfile, mode='w')
+            else:
+                ds_m.drop_vars(['longitude', 'latitude']).to_zarr(tmpfile, append_dim='time')
+        else:
+            append_netcdf(ds_m, tmpfile, first=(t0==0))
+    
+    ds.close()
+    replace_store(tmpfile, outfile) # only complete files get the final name
+    
+    return outfile
+
+
+def get_regridder(lat_e, lon_e, lat_m, lon_m, weights_file=None, method='bilinear', nsub=5):
+    """
+    Regridder read from weights_file if it exists and was made for the same 
+    grids and method, otherwise computed and saved to weights_file
+    """
+    if weights_file is not None and os.path.isfile(weights_file):
+        regridder = Regridder.load(weights_file)
+        if regridder.matches(lat_e, lon_e, lat_m, lon_m, method=method, nsub=nsub):
+            return regridder
+        print('weights in', weights_file, 'are for other grids, recomputing')
+    
+    regridder = Regridder(lat_e, lon_e, lat_m, lon_m, method=method, nsub=nsub)
+    if weights_file is not None:
+        regridder.save(weights_file)
+    return regridder
+
+
+def get_era_crop(lat_e, lon_e, lat_m, lon_m, method='bilinear'):
+    """
+    Index ranges (slices) of the ERA5 latitudes and longitudes needed to 
+    interpolate to the model points. The whole longitude range is kept if the 
+    model points cross the first ERA5 longitude
+    """
+    weights = Regridder(lat_e, lon_e, lat_m, lon_m, method=method).weights
+    cols = np.unique(weights.indices)
+    
+    ilat = cols // len(lon_e)
+    ilon = cols % len(lon_e)
+    
+    lat_slice = slice(int(ilat.min()), int(ilat.max()) + 1)
+    if (ilon.min()==0) and (ilon.max()==len(lon_e)-1): # wraps around the first longitude
+        lon_slice = slice(None)
+    else:
+        lon_slice = slice(int(ilon.min()), int(ilon.max()) + 1)
+    
+    return lat_slice, lon_slice
+
+
+def append_netcdf(ds, ncfile, first=False):
+    """
+    Append dataset along an unlimited time dimension of a compressed, chunked 
+    NetCDF file. If first=True the file is created
+    """
+    if first:
+        encoding = {var:{'zlib':True, 'complevel':4, 'dtype':'float32',
+                         'chunksizes':(1,) + ds[var].shape[1:]} for var in ds.data_vars}
+        # fixed time units, so later (sub-daily) chunks are not truncated to the units of the first
+        encoding['time'] = {'units':'hours since 1900-01-01', 'calendar':'gregorian', 'dtype':'float64'}
+        ds.to_netcdf(ncfile, mode='w', unlimited_dims=['time'], encoding=encoding)
+        return
+    
+    with Dataset(ncfile, mode='a') as nc:
+        ntime = len(nc.dimensions['time'])
+        nc['time'][ntime:] = date2num(ds.time.values.astype('datetime64[s]').astype(dt.datetime),
+                                      nc['time'].units, nc['time'].calendar)
+        for var in ds.data_vars:
+            nc[var][ntime:] = ds[var].values
@@ -0,0 +1,42 @@
+## Atomic writes of NetCDF files and Zarr stores
+
+import os
+import shutil
+
+#########################################################
+def replace_store(tmp_store, store):
+    """Move a completely written file or Zarr store to its final name, replacing an existing one"""
+    if os.path.isdir(store):
+        shutil.rmtree(store)
+    os.replace(tmp_store, store)
+
+def write_store(ds, store, zarr=None, **kwargs):
+    """
+    Write a dataset under a temporary name (store + '.tmp') and move it in
+    place, so an interrupted write never leaves an incomplete store
+
+    Parameters:
+    -----------
+    ds : xarray.Dataset
+    store : (str) output file or Zarr store
+    zarr : bool
+        write Zarr instead of NetCDF. Default is True if store ends with '.zarr'
+    kwargs :
+        passed to Dataset.to_zarr or Dataset.to_netcdf
+    """
+    if zarr is None:
+        zarr = store.endswith('.zarr')
+    tmp_store = store + '.tmp'
+    if os.path.isdir(tmp_store):
+        shutil.rmtree(tmp_store) # left over from an interrupted run
+
+    ds = ds.copy()
+    for var in ds.variables:
+        # drop NetCDF encoding (chunksizes, compression) of the input files
+        ds[var].encoding = {}
+
+    if zarr:
+        ds.to_zarr(tmp_store, mode='w', **kwargs)
+    else:
+        ds.to_netcdf(tmp_store, **kwargs)
+    replace_store(tmp_store, store)
@@ -7,10 +7,15 @@ import xarray as xr
 import numpy as np
 import process_data
 
+indir = '/home/rheinlender/shared-simstore-ns9829k/NANUK/NANUK025-ILBOXE140-S/'
+cache_dir = '/home/rheinlender/shared-simstore-ns9829k/NANUK/cache/'
+
 months = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
 years = list(range(1995, 2019))
 
-ds =  process_data.subset_data_dailyMean(months, years, region='Beaufort')
+# daily means are stored in the Zarr cache and reused by the notebooks 
+ds = process_data.load_moorings(indir, months, years, region='Beaufort', period='daily', 
+                                pushdown=True, cache_dir=cache_dir)
 
 #print('save to netcdf')
 # save to netcdf
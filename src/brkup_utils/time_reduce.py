@@ -0,0 +1,219 @@
+## Streaming time aggregation of nextsim moorings
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+PERIODS = ['daily', 'monthly', 'year-month', 'season']
+STATS = ['mean', 'std', 'min', 'max']
+
+#########################################################
+class StreamingReducer:
+    """
+    Accumulates running sums/counts per output period while walking the
+    mooring files one at a time, so only one month of data is in memory
+    """
+
+    def __init__(self, period='daily', stats=['mean'], quantiles=None, bins=None,
+                 variables=None, season_months=[1, 2, 3]):
+        """
+        Parameters:
+        -----------
+        period : (str)
+            'daily', 'monthly' (climatological month), 'year-month' or
+            'season' (season_months of each year, e.g. JFM). A season across 
+            the new year, e.g. [12, 1, 2], is labelled by the year of its last month
+        stats : list(str)
+            any of 'mean', 'std', 'min', 'max'
+        quantiles : list(float)
+            quantiles to estimate, e.g. [0.5, 0.9]. Requires 'bins'
+        bins : array
+            bin edges of the histogram sketch used for the quantiles
+        variables : list(str)
+            variables to reduce. Default is all variables with a time dimension
+        season_months : list(int) consecutive months in the season, from the first
+        """
+        if period not in PERIODS:
+            raise ValueError("Unknown period:", period)
+        first = season_months[0]
+        if list(season_months) != [(first - 1 + i) % 12 + 1 for i in range(len(season_months))]:
+            raise ValueError("season_months must be consecutive months:", season_months)
+        for stat in stats:
+            if stat not in STATS:
+                raise ValueError("Unknown statistic:", stat)
+        if quantiles is not None and bins is None:
+            raise ValueError("bins are needed to estimate quantiles")
+
+        self.period = period
+        self.stats = stats
+        self.quantiles = quantiles
+        self.bins = None if bins is None else np.asarray(bins, dtype=float)
+        self.variables = variables
+        self.season_months = season_months
+
+        self.acc = {}         # accumulators for each period label
+        self.template = None  # static coordinates from first dataset
+
+    def get_labels(self, time):
+        """Output period label of every time step"""
+        time = pd.DatetimeIndex(time)
+        if self.period == 'daily':
+            return time.floor('1D').values
+        elif self.period == 'year-month':
+            return time.to_period('M').to_timestamp().values
+        elif self.period == 'monthly':
+            return time.month.values
+        elif self.period == 'season':
+            labels = time.year.values.astype(float)
+            # months before the new year belong to the season of the next year
+            if self.season_months[-1] < self.season_months[0]:
+                labels[time.month >= self.season_months[0]] += 1
+            labels[~np.isin(time.month, self.season_months)] = np.nan
+            return labels
+
+    def update(self, ds):
+        """
+        Add a dataset (e.g. one monthly mooring file) to the running statistics
+
+        Parameters:
+        -----------
+        ds : xarray.Dataset with a time dimension
+        """
+        if self.variables is None:
+            self.variables = [var for var in ds.data_vars if 'time' in ds[var].dims]
+
+        ds = ds[self.variables].load()
+        if self.template is None:
+            self.template = ds.isel(time=0, drop=True).drop_vars(self.variables)
+
+        labels = self.get_labels(ds.time.values)
+        for label in pd.unique(labels):
+            if pd.isnull(label):
+                continue
+            idx = np.where(labels == label)[0]
+            acc = self.acc.setdefault(label, {})
+            for var in self.variables:
+                self._accumulate(acc, var, ds[var].isel(time=idx))
+
+    def _accumulate(self, acc, var, da):
+        vals = da.values.astype(np.float64)
+        valid = ~np.isnan(vals)
+        filled = np.where(valid, vals, 0)
+
+        if var not in acc:
+            shp = vals.shape[1:]
+            acc[var] = {'dims':da.dims[1:],
+                        'count':np.zeros(shp), 'mean':np.zeros(shp), 'm2':np.zeros(shp),
+                        'min':np.full(shp, np.inf), 'max':np.full(shp, -np.inf)}
+            if self.quantiles is not None:
+                acc[var]['hist'] = np.zeros((len(self.bins)-1,) + shp)
+        a = acc[var]
+
+        # merge mean and sum of squared deviations of this chunk with the 
+        # running ones (Chan et al.), stable for a large mean and small spread
+        n_b = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(n_b > 0, filled.sum(axis=0)/n_b, 0)
+            n = a['count'] + n_b
+            delta = mean_b - a['mean']
+            frac = np.where(n > 0, n_b/n, 0)
+        a['mean'] += delta*frac
+        if 'std' in self.stats:
+            m2_b = (np.where(valid, vals - mean_b, 0)**2).sum(axis=0)
+            a['m2'] += m2_b + delta**2*a['count']*frac
+        a['count'] = n
+        if 'min' in self.stats:
+            a['min'] = np.fmin(a['min'], np.where(valid, vals, np.inf).min(axis=0))
+        if 'max' in self.stats:
+            a['max'] = np.fmax(a['max'], np.where(valid, vals, -np.inf).max(axis=0))
+        if self.quantiles is not None:
+            a['hist'] += self._histogram(vals, valid)
+
+    def _histogram(self, vals, valid):
+        """Histogram counts per grid cell (nbins, ...) in a single bincount"""
+        nbins = len(self.bins) - 1
+        shp = vals.shape[1:]
+        ncell = int(np.prod(shp))
+        ibin = np.clip(np.searchsorted(self.bins, vals, side='right') - 1, 0, nbins - 1)
+        icell = np.broadcast_to(np.arange(ncell).reshape(shp), vals.shape)
+        flat = (ibin*ncell + icell)[valid]
+        return np.bincount(flat, minlength=nbins*ncell).reshape((nbins,) + shp)
+
+    def _quantile(self, hist, count, q):
+        """Quantile estimated from the histogram sketch (linear within each bin)"""
+        cum = np.cumsum(hist, axis=0)
+        target = q*count
+        ibin = np.argmax(cum >= target[np.newaxis], axis=0)
+        below = np.take_along_axis(cum, ibin[np.newaxis], axis=0)[0] - \
+                np.take_along_axis(hist, ibin[np.newaxis], axis=0)[0]
+        inbin = np.take_along_axis(hist, ibin[np.newaxis], axis=0)[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(inbin > 0, (target - below)/inbin, 0)
+        width = np.diff(self.bins)[ibin]
+        out = self.bins[ibin] + np.clip(frac, 0, 1)*width
+        out[count == 0] = np.nan
+        return out
+
+    def finalize(self, label):
+        """Returns the statistics for one period label and frees its accumulators"""
+        acc = self.acc.pop(label)
+        data_vars = {}
+        for var, a in acc.items():
+            count = a['count']
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if 'mean' in self.stats:
+                    data_vars[var] = (a['dims'], np.where(count > 0, a['mean'], np.nan))
+                if 'std' in self.stats:
+                    data_vars[var + '_std'] = (a['dims'], np.where(count > 0, np.sqrt(a['m2']/count), np.nan))
+            if 'min' in self.stats:
+                data_vars[var + '_min'] = (a['dims'], np.where(count > 0, a['min'], np.nan))
+            if 'max' in self.stats:
+                data_vars[var + '_max'] = (a['dims'], np.where(count > 0, a['max'], np.nan))
+            if self.quantiles is not None:
+                for q in self.quantiles:
+                    data_vars[var + f'_q{int(round(q*100))}'] = (a['dims'],
+                                                                self._quantile(a['hist'], count, q))
+
+        if self.period == 'season':
+            label = int(label)
+
+        ds = self.template.assign(data_vars)
+        return ds.expand_dims({self.label_dim(): [label]})
+
+    def label_dim(self):
+        return {'daily':'time', 'year-month':'time', 'monthly':'month', 'season':'year'}[self.period]
+
+    def iter_reduce(self, files, preprocess=None):
+        """
+        Walk through the files in time order and yield the statistics of each
+        period as soon as it is complete
+
+        Parameters:
+        -----------
+        files : list(str) mooring files in time order
+        preprocess : function applied to each dataset after opening, e.g. a bbox selection
+
+        Yields:
+        --------
+        xarray.Dataset for one period
+        """
+        for fl in files:
+            with xr.open_dataset(fl) as ds:
+                if preprocess is not None:
+                    ds = preprocess(ds)
+                self.update(ds)
+                last = self.get_labels(ds.time.values[-1:])[0]
+
+            if self.period == 'monthly':
+                continue # climatological months are only complete at the end
+            for label in sorted(self.acc):
+                if label < last:
+                    yield self.finalize(label)
+
+        for label in sorted(self.acc):
+            yield self.finalize(label)
+
+    def reduce(self, files, preprocess=None):
+        """Returns the statistics for all periods as one dataset"""
+        return xr.concat(list(self.iter_reduce(files, preprocess)), dim=self.label_dim(),
+                         data_vars='minimal', coords='minimal', compat='override')